@@ -0,0 +1,61 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from run_bench import repo_dir, free_port, start_server, run_measured
+
+
+def cold_start_modes(root_url):
+    py = sys.executable
+    se = os.path.join(repo_dir, 'crawler-stackexchange.py')
+    aops = os.path.join(repo_dir, 'crawler-artofproblemsolving.com.py')
+    return {
+        'stackexchange --help': [py, se, '--help'],
+        'stackexchange --post': [py, se, '--root-url', root_url,
+            '--post', '1886701'],
+        'artofproblemsolving --help': [py, aops, '--help'],
+        'artofproblemsolving --topic': [py, aops, '--root-url', root_url,
+            '--delay', '0', '-c', '6', '-t', '1'],
+    }
+
+
+def measure_modes(args):
+    port = free_port()
+    replay = start_server('replay_server.py', port)
+    results = {}
+    try:
+        for mode, cmd in cold_start_modes(f'http://127.0.0.1:{port}').items():
+            runs = []
+            for _ in range(args.repeat):
+                # a fresh working directory, so nothing is cached on disk
+                workdir = tempfile.mkdtemp(prefix='a0-cold-')
+                runs.append(run_measured(cmd, workdir,
+                    os.path.join(workdir, 'cold_start.log')))
+                shutil.rmtree(workdir)
+            runs.sort(key=lambda m: m['seconds'])
+            median = runs[len(runs) // 2]
+            results[mode] = {
+                'ms': round(1000 * median['seconds'], 1),
+                'cpu_ms': round(1000 * median['cpu_seconds'], 1),
+                'peak_rss_mb': round(median['peak_rss_mb'], 1)
+            }
+    finally:
+        replay.kill()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure crawler startup time (to first document).'
+    )
+    parser.add_argument(
+        '--repeat', help='number of runs per mode, report the median '
+        '(default: 5)', type=int, default=5
+    )
+    args = parser.parse_args()
+
+    results = measure_modes(args)
+    print(f'{"mode":>30}{"ms":>12}{"cpu_ms":>12}{"peak_rss_mb":>14}')
+    for mode, r in results.items():
+        print(f'{mode:>30}{r["ms"]:>12}{r["cpu_ms"]:>12}{r["peak_rss_mb"]:>14}')
@@ -0,0 +1,172 @@
+import os
+import re
+import sys
+import time
+import json
+import random
+import hashlib
+import argparse
+import threading
+import urllib.request
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json'), 'r') as fh:
+        return json.load(fh)
+
+
+def save_manifest(directory, manifest):
+    with open(os.path.join(directory, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh, indent=4)
+
+
+def match_fixture(manifest, method, path, query, form):
+    for entry in manifest:
+        if entry['method'] != method:
+            continue
+        if not re.search(entry['path'], path):
+            continue
+        if any(query.get(k) != v for k, v in entry.get('query', {}).items()):
+            continue
+        if any(form.get(k) != v for k, v in entry.get('form', {}).items()):
+            continue
+        return entry
+    return None
+
+
+def content_type(filename):
+    if filename.endswith('.json'):
+        return 'application/json'
+    return 'text/html; charset=utf-8'
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    options = None
+    manifest = None
+    lock = threading.Lock()
+    stats = {'requests': 0, 'errors_injected': 0, 'misses': 0}
+
+    def do_GET(self):
+        self.replay('GET', {}, None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        form = dict(parse_qsl(body.decode('utf-8')))
+        self.replay('POST', form, body)
+
+    def replay(self, method, form, body):
+        opt = self.options
+        with self.lock:
+            self.stats['requests'] += 1
+        url = urlsplit(self.path)
+        if url.path == '/__stats__':
+            return self.respond(200, json.dumps(self.stats).encode(),
+                'application/json')
+
+        # simulate network latency and server errors
+        latency = opt.latency + random.uniform(0, opt.jitter)
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+        if random.random() < opt.error_rate:
+            with self.lock:
+                self.stats['errors_injected'] += 1
+            if random.random() < 0.5:
+                # drop the connection without any response
+                self.close_connection = True
+                return
+            return self.respond(503, b'Service Unavailable', 'text/plain')
+
+        query = dict(parse_qsl(url.query))
+        entry = match_fixture(self.manifest, method, url.path, query, form)
+        if entry is None and opt.record:
+            entry = self.record(method, url, query, form, body)
+        if entry is None:
+            with self.lock:
+                self.stats['misses'] += 1
+            return self.respond(404, b'no fixture', 'text/plain')
+        with open(os.path.join(opt.fixtures, entry['file']), 'rb') as fh:
+            self.respond(200, fh.read(), content_type(entry['file']))
+
+    def record(self, method, url, query, form, body):
+        # forward to upstream and save the response as a new fixture
+        upstream = self.options.record.rstrip('/') + self.path
+        req = urllib.request.Request(upstream, data=body, method=method,
+            headers={'User-Agent': self.headers.get('User-Agent', '')})
+        with urllib.request.urlopen(req, timeout=30) as res:
+            data = res.read()
+            is_json = 'json' in res.headers.get('Content-Type', '')
+        digest = hashlib.sha1(f'{method} {self.path} {form}'.encode()).hexdigest()
+        filename = f"recorded/{digest[:16]}.{'json' if is_json else 'html'}"
+        os.makedirs(os.path.join(self.options.fixtures, 'recorded'), exist_ok=True)
+        with open(os.path.join(self.options.fixtures, filename), 'wb') as fh:
+            fh.write(data)
+        entry = {'method': method, 'path': '^' + re.escape(url.path) + '$',
+            'query': query, 'form': form, 'file': filename}
+        with self.lock:
+            self.manifest.append(entry)
+            save_manifest(self.options.fixtures, self.manifest)
+        print(f'[record] {method} {self.path} -> {filename}')
+        return entry
+
+    def respond(self, code, data, ctype):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(options):
+    ReplayHandler.options = options
+    ReplayHandler.manifest = load_manifest(options.fixtures)
+    return ThreadingHTTPServer((options.host, options.port), ReplayHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay recorded crawler fixtures over HTTP.'
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--fixtures', help=f'fixture directory (default: {fixtures_dir})',
+        type=str, default=fixtures_dir
+    )
+    parser.add_argument(
+        '--latency', help='added latency per request in ms',
+        type=float, default=0.0
+    )
+    parser.add_argument(
+        '--jitter', help='uniformly random extra latency in ms',
+        type=float, default=0.0
+    )
+    parser.add_argument(
+        '--error-rate', help='fraction of requests answered by 503 or dropped',
+        type=float, default=0.0
+    )
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument(
+        '--record', help='upstream root URL to record unknown requests from',
+        type=str, default=None
+    )
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = make_server(args)
+    print(f'[replay] http://{args.host}:{args.port} from {args.fixtures}')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
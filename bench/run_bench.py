@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import json
+import glob
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+default_baseline = os.path.join(bench_dir, 'baseline.json')
+
+# metric name -> +1 if higher is better, -1 if lower is better
+METRICS = {'docs_per_sec': +1, 'cpu_ms_per_doc': -1, 'peak_rss_mb': -1}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(script, port, extra_args=[]):
+    cmd = [sys.executable, os.path.join(bench_dir, script), '--port', str(port)]
+    proc = subprocess.Popen(cmd + extra_args, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise Exception(f'{script} did not start')
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=5) as res:
+        return json.loads(res.read().decode('utf-8'))
+
+
+def run_measured(cmd, cwd, log_path):
+    # measure wall time, CPU time and peak RSS of exactly this child
+    with open(log_path, 'w') as log:
+        begin = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=log, stderr=log)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - begin
+    # os.waitstatus_to_exitcode() needs Python 3.9
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return {
+        'exit_code': proc.returncode,
+        'seconds': seconds,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        'peak_rss_mb': rusage.ru_maxrss / 1024.0 # ru_maxrss is in KB on Linux
+    }
+
+
+def summarize(measure, docs):
+    return {
+        'docs': docs,
+        'exit_code': measure['exit_code'],
+        'seconds': round(measure['seconds'], 3),
+        'docs_per_sec': round(docs / measure['seconds'], 2),
+        'cpu_ms_per_doc': round(1000 * measure['cpu_seconds'] / max(docs, 1), 3),
+        'peak_rss_mb': round(measure['peak_rss_mb'], 1)
+    }
+
+
+def count_docs(workdir, pattern):
+    return len(glob.glob(os.path.join(workdir, 'tmp', '*', pattern)))
+
+
+def run_once(args, workdir):
+    replay_port, indexd_port = free_port(), free_port()
+    replay = start_server('replay_server.py', replay_port, [
+        '--latency', str(args.latency),
+        '--error-rate', str(args.error_rate),
+        '--seed', '1'
+    ])
+    indexd = start_server('stub_indexd.py', indexd_port)
+    # local stand-ins for egress routes, see --egress
+    proxies, egress_args = [], []
+    for _ in range(args.egress):
+        proxy_port = free_port()
+        proxies.append(start_server('stub_proxy.py', proxy_port, [
+            '--max-rate', str(args.proxy_max_rate)
+        ]))
+        egress_args += ['--egress', f'http://127.0.0.1:{proxy_port}']
+    if args.egress > 0:
+        egress_args += ['--egress-cooldown', '1']
+    root_url = f'http://127.0.0.1:{replay_port}'
+    indexd_url = f'http://127.0.0.1:{indexd_port}/index'
+    py = sys.executable
+    results = {}
+    try:
+        m = run_measured([
+            py, os.path.join(repo_dir, 'crawler-stackexchange.py'),
+            '--root-url', root_url, '--delay', str(args.delay),
+            '-b', '1', '-e', '3'
+        ] + egress_args, workdir, os.path.join(workdir, 'stackexchange.log'))
+        results['stackexchange'] = summarize(m, count_docs(workdir, 'mse*.json'))
+
+        m = run_measured([
+            py, os.path.join(repo_dir, 'crawler-artofproblemsolving.com.py'),
+            '--root-url', root_url, '--delay', '0',
+            '-c', '6', '-n', '0', '-o', '1'
+        ], workdir, os.path.join(workdir, 'artofproblemsolving.log'))
+        results['artofproblemsolving'] = summarize(m,
+            count_docs(workdir, 'aops-*.json'))
+
+        m = run_measured([
+            py, os.path.join(repo_dir, 'feeder', 'feeder.py'),
+            os.path.join(repo_dir, 'feeder', 'feeder.ini'), './tmp',
+            '--corpus', 'crawler', '--indexd-url', indexd_url
+        ], workdir, os.path.join(workdir, 'feeder.log'))
+        results['feeder'] = summarize(m,
+            get_json(f'http://127.0.0.1:{indexd_port}/')['docs'])
+    finally:
+        replay.kill()
+        indexd.kill()
+        for proxy in proxies:
+            proxy.kill()
+    return results
+
+
+def median_results(runs):
+    merged = {}
+    for stage in runs[0]:
+        merged[stage] = {}
+        for key in runs[0][stage]:
+            values = sorted(r[stage][key] for r in runs)
+            merged[stage][key] = values[len(values) // 2]
+    return merged
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for stage, base in baseline.items():
+        cur = results.get(stage)
+        if cur is None:
+            failures.append(f'{stage}: missing')
+            continue
+        if cur['exit_code'] != 0:
+            failures.append(f'{stage}: exit code {cur["exit_code"]}')
+        if cur['docs'] != base['docs']:
+            failures.append(f'{stage}: {cur["docs"]} docs, expected {base["docs"]}')
+        for metric, direction in METRICS.items():
+            limit = base[metric] * (1 - direction * tolerance)
+            if direction * (cur[metric] - limit) < 0:
+                failures.append(f'{stage}: {metric} {cur[metric]} '
+                    f'(baseline {base[metric]}, limit {round(limit, 3)})')
+    return failures
+
+
+def print_table(results):
+    header = ['stage', 'docs', 'seconds', 'docs_per_sec',
+        'cpu_ms_per_doc', 'peak_rss_mb']
+    print(''.join(f'{h:>20}' for h in header))
+    for stage, r in results.items():
+        print(f'{stage:>20}' + ''.join(f'{r[h]:>20}' for h in header[1:]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Offline crawler and feeder benchmark on recorded fixtures.'
+    )
+    parser.add_argument(
+        '--baseline', help=f'baseline file (default: {default_baseline})',
+        type=str, default=default_baseline
+    )
+    parser.add_argument(
+        '--update-baseline', help='store the results as new baseline',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--tolerance', help='allowed relative regression (default: 0.25)',
+        type=float, default=0.25
+    )
+    parser.add_argument(
+        '--repeat', help='number of runs, report the median (default: 1)',
+        type=int, default=1
+    )
+    parser.add_argument(
+        '--latency', help='replay server latency per request in ms',
+        type=float, default=0.0
+    )
+    parser.add_argument(
+        '--error-rate', help='replay server error injection rate',
+        type=float, default=0.0
+    )
+    parser.add_argument(
+        '--delay', help='StackExchange crawler --delay (default: 0)',
+        type=float, default=0.0
+    )
+    parser.add_argument(
+        '--egress', help='crawl StackExchange through this many local proxies',
+        type=int, default=0
+    )
+    parser.add_argument(
+        '--proxy-max-rate', help='requests per second each local proxy '
+        'allows before answering 429 (default: 0, no limit)',
+        type=float, default=0
+    )
+    parser.add_argument(
+        '--keep', help='keep the working directories', action='store_true'
+    )
+    args = parser.parse_args()
+
+    runs = []
+    for i in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix='a0-bench-')
+        runs.append(run_once(args, workdir))
+        if args.keep:
+            print(f'[workdir] {workdir}')
+        else:
+            shutil.rmtree(workdir)
+    results = median_results(runs)
+    print_table(results)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump(results, fh, indent=4)
+        print(f'baseline updated: {args.baseline}')
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+        failures = compare(results, baseline, args.tolerance)
+        for failure in failures:
+            print('[regression]', failure)
+        if failures:
+            quit(1)
+        print('no regression against', args.baseline)
+    else:
+        print(f'no baseline at {args.baseline}, use --update-baseline')
@@ -0,0 +1,69 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class IndexdHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    options = None
+    lock = threading.Lock()
+    stats = {'docs': 0, 'bytes': 0}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        j = json.loads(self.rfile.read(length).decode('utf-8'))
+        if self.options.latency > 0:
+            time.sleep(self.options.latency / 1000.0)
+        with self.lock:
+            if 'cmd' in j:
+                res = {'cmd': j['cmd']}
+            else:
+                res = {'docid': self.stats['docs']}
+                self.stats['docs'] += 1
+                self.stats['bytes'] += length
+        self.respond(res)
+
+    def do_GET(self):
+        # query how many documents have been "indexed"
+        with self.lock:
+            self.respond(dict(self.stats))
+
+    def respond(self, j):
+        data = json.dumps(j).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(options):
+    IndexdHandler.options = options
+    return ThreadingHTTPServer((options.host, options.port), IndexdHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stub index daemon accepting documents without indexing.'
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8934)
+    parser.add_argument(
+        '--latency', help='added latency per document in ms',
+        type=float, default=0.0
+    )
+    args = parser.parse_args()
+
+    server = make_server(args)
+    print(f'[stub indexd] http://{args.host}:{args.port}/index')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
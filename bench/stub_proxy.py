@@ -0,0 +1,105 @@
+import sys
+import time
+import json
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# forward to the target as given, never through another proxy
+opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """
+    Minimal forward HTTP proxy standing in for one egress route. Like a
+    host limiting requests per client address, it answers 429 to
+    requests beyond --max-rate per second.
+    """
+    # set by make_server()
+    options = None
+    lock = threading.Lock()
+    stats = {'requests': 0, 'throttled': 0, 'failed': 0}
+    recent = []
+
+    def do_GET(self):
+        self.forward(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.forward(self.rfile.read(length))
+
+    def over_rate(self):
+        # sliding one-second window
+        now = time.monotonic()
+        with self.lock:
+            self.stats['requests'] += 1
+            self.recent[:] = [t for t in self.recent if now - t < 1.0]
+            if 0 < self.options.max_rate <= len(self.recent):
+                self.stats['throttled'] += 1
+                return True
+            self.recent.append(now)
+        return False
+
+    def forward(self, body):
+        if self.path == '/__stats__':
+            return self.respond(200, json.dumps(self.stats).encode())
+        if self.over_rate():
+            return self.respond(429, b'Too Many Requests')
+        if random.random() < self.options.fail_rate:
+            with self.lock:
+                self.stats['failed'] += 1
+            self.close_connection = True
+            return
+        headers = {k: v for k, v in self.headers.items()
+            if k.lower() not in ('host', 'proxy-connection', 'connection')}
+        req = urllib.request.Request(self.path, data=body,
+            headers=headers, method=self.command)
+        try:
+            with opener.open(req, timeout=30) as res:
+                self.respond(res.status, res.read())
+        except urllib.error.HTTPError as e:
+            self.respond(e.code, e.read())
+
+    def respond(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(options):
+    ProxyHandler.options = options
+    return ThreadingHTTPServer((options.host, options.port), ProxyHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Local HTTP proxy standing in for an egress route.'
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3128)
+    parser.add_argument(
+        '--max-rate', help='requests per second before answering 429 '
+        '(default: 0, no limit)', type=float, default=0
+    )
+    parser.add_argument(
+        '--fail-rate', help='fraction of connections dropped',
+        type=float, default=0.0
+    )
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = make_server(args)
+    print(f'[stub proxy] http://{args.host}:{args.port}')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
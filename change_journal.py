@@ -0,0 +1,82 @@
+import os
+import time
+import json
+import threading
+
+JOURNAL_ACTIONS = ["created", "updated", "unchanged", "duplicate"]
+
+
+class ChangeJournal:
+    """
+    Append-only JSONL journal of the documents touched in one crawling
+    pass, rotated per pass, so that downstream jobs only process deltas.
+    Only the newest `keep` journals of a prefix are kept (all if keep is
+    0), older ones are deleted whether they have been consumed or not.
+    """
+
+    def __init__(self, directory: str, prefix: str, keep=100):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        self.path = None
+        self.fh = None
+        # passes journaled by this process, several may start in a second
+        self.seq = 0
+        self.counts = {}
+        # crawl threads and the pipeline writer may record concurrently
+        self.lock = threading.Lock()
+
+    def open(self):
+        self.seq += 1
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        name = f"{self.prefix}-{stamp}-{os.getpid()}-{self.seq:05d}.jsonl"
+        self.path = os.path.join(self.directory, name)
+        self.fh = open(self.path, "a")
+        self.counts = {action: 0 for action in JOURNAL_ACTIONS}
+
+    def record(self, action: str, file_path: str, src_id=None):
+        # src_id: where the document was written (see post_sink), by
+        # default its JSON file
+        line = json.dumps({
+            "action": action,
+            "id": os.path.basename(file_path),
+            "path": os.path.abspath(src_id or f"{file_path}.json")
+        })
+        with self.lock:
+            if self.fh is None:
+                self.open()
+            self.counts[action] += 1
+            self.fh.write(line + "\n")
+
+    def rotate(self) -> str:
+        # close the journal of this pass and return its path
+        with self.lock:
+            if self.fh is None:
+                self.open()
+            self.fh.close()
+            self.fh = None
+        print("[journal]", self.path, self.counts)
+        self.expire()
+        return self.path
+
+    def expire(self):
+        if self.keep <= 0:
+            return
+        journals = sorted(
+            f for f in os.listdir(self.directory)
+            if f.startswith(f"{self.prefix}-") and f.endswith(".jsonl")
+        )
+        for f in journals[:-self.keep]:
+            print(f"[journal] expired {f}, keeping the last {self.keep}")
+            os.remove(os.path.join(self.directory, f))
+
+    def close(self):
+        if self.fh is not None:
+            self.rotate()
+
+
+def read_journal(path: str):
+    with open(path, "r") as fh:
+        for line in fh:
+            yield json.loads(line)
@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import threading
+from stage_metrics import observe
+
+# marks that all pieces of an item have been handed to the writer
+ITEM_DONE = object()
+
+
+def timed_call(func, arg):
+    # runs in a worker process, whose metrics are not visible in the
+    # parent process, so report the elapsed time back.
+    begin = time.perf_counter()
+    result = func(arg)
+    return result, time.perf_counter() - begin
+
+
+def noop():
+    return None
+
+
+def call_inline(func, arg):
+    # offload() stand-in for running a fetch stage outside of a pipeline
+    return func(arg)
+
+
+class Pipeline:
+    """
+    Three stages connected by bounded queues:
+
+    fetch(item, offload): generator run by I/O threads, yields raw pieces
+        (e.g., downloaded pages) of an item. It can use offload(func, arg)
+        to run CPU-bound work it depends on in the process pool.
+    extract(piece): CPU-bound parsing and TeX normalization of a piece,
+        run in the process pool, so must be a picklable module function.
+    write(item, result): commits one extracted piece, run by a single
+        writer thread, so outputs (sinks) need no locking.
+
+    fail(item, err) is called (by the writer thread) for failed items,
+    and done(item), if given, for items whose pieces are all written.
+
+    Items can be submitted in groups (e.g., one per crawled site), and
+    each group can be joined on its own.
+    """
+
+    def __init__(self, fetch, extract, write, fail, done=None,
+            jobs=None, fetchers=1, depth=64):
+        # only imported by -j, to keep the default startup short
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.fetch = fetch
+        self.extract = extract
+        self.write = write
+        self.fail = fail
+        self.done = done
+        # fork, so that functions of the (hyphen-named) crawler scripts
+        # can be pickled by reference.
+        self.pool = ProcessPoolExecutor(
+            jobs or os.cpu_count(),
+            mp_context=multiprocessing.get_context("fork")
+        )
+        # start the worker processes now, before any thread is running
+        self.pool.submit(noop).result()
+
+        self.fetch_q = queue.Queue(maxsize=depth)
+        self.write_q = queue.Queue(maxsize=depth)
+        self.pending = {}
+        self.succ = {}
+        self.cond = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self.fetcher, daemon=True)
+            for _ in range(fetchers)
+        ]
+        self.threads.append(threading.Thread(target=self.writer, daemon=True))
+        for t in self.threads:
+            t.start()
+
+    def offload(self, func, arg):
+        result, seconds = self.pool.submit(timed_call, func, arg).result()
+        observe(func.__name__, seconds)
+        return result
+
+    def fetcher(self):
+        while True:
+            entry = self.fetch_q.get()
+            if entry is None:
+                break
+            group, item = entry
+            try:
+                for piece in self.fetch(item, self.offload):
+                    future = self.pool.submit(timed_call, self.extract, piece)
+                    self.write_q.put((group, item, future, None))
+            except Exception as err:
+                self.write_q.put((group, item, None, err))
+            self.write_q.put((group, item, ITEM_DONE, None))
+
+    def writer(self):
+        failed = set()
+        while True:
+            entry = self.write_q.get()
+            if entry is None:
+                break
+            group, item, future, err = entry
+            if future is ITEM_DONE:
+                succ = id(item) not in failed
+                failed.discard(id(item))
+                if succ and self.done is not None:
+                    self.done(item)
+                with self.cond:
+                    if succ:
+                        self.succ[group] = self.succ.get(group, 0) + 1
+                    self.pending[group] -= 1
+                    self.cond.notify_all()
+                continue
+            try:
+                if err is not None:
+                    raise err
+                result, seconds = future.result()
+                observe(self.extract.__name__, seconds)
+                self.write(item, result)
+            except Exception as e:
+                if id(item) not in failed:
+                    failed.add(id(item))
+                    self.fail(item, e)
+
+    def submit(self, item, group=None):
+        with self.cond:
+            self.pending[group] = self.pending.get(group, 0) + 1
+        self.fetch_q.put((group, item))
+
+    def join(self, group=None) -> int:
+        # wait for submitted items of a group, return and reset its
+        # success count
+        with self.cond:
+            while self.pending.get(group, 0) > 0:
+                self.cond.wait(timeout=1.0)
+            return self.succ.pop(group, 0)
+
+    def close(self):
+        for _ in range(len(self.threads) - 1):
+            self.fetch_q.put(None)
+        for t in self.threads[:-1]:
+            t.join()
+        self.write_q.put(None)
+        self.threads[-1].join()
+        # the writer has waited for every extraction, nothing is pending
+        self.pool.shutdown(wait=True)
+
+    def abort(self):
+        # cancel extractions not started yet, by hand, shutdown() only
+        # does it (cancel_futures) from Python 3.9 on, then wait for the
+        # running ones, shutdown(wait=False) can hang the exit on 3.7.
+        while True:
+            try:
+                entry = self.write_q.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not None and entry[2] not in (None, ITEM_DONE):
+                entry[2].cancel()
+        self.pool.shutdown(wait=True)
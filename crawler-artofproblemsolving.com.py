@@ -1,23 +1,26 @@
 #!/usr/bin/python3
 import time
-import pycurl
-import certifi
 import os
-import errno
 import json
 import sys
+import shlex
 import getopt
-import filecmp
+import re
 import html
 from urllib.parse import urlencode
+from post_sink import SINK_NAMES, DEDUP_MODES, dedup_options
+from post_sink import make_sinks, write_to_sinks, flush_sinks, close_sinks
+from change_journal import ChangeJournal
+from stage_metrics import timed, instrument, incr
+from stage_metrics import serve_metrics, dump_json_periodically, enable_profile
+from crawl_pipeline import call_inline
+from retry_queue import RetryQueue, retry_soon
 from replace_post_tex import replace_dollar_tex
 from replace_post_tex import replace_display_tex
 from replace_post_tex import replace_inline_tex
-from slimit import ast
-from slimit.parser import Parser
+from slimit_tables import get_parser
+from user_agents import random_user_agent
 from io import BytesIO
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
 
 root_url = "https://artofproblemsolving.com"
 file_prefix = "aops"
@@ -27,8 +30,20 @@ vt100_WARNING = "\033[93m"
 vt100_RESET = "\033[0m"
 DIVISIONS = 500
 
-# load parser globally for sharing, it is painfully slow
-slimit_parser = Parser()
+# where crawled documents go, see post_sink.py
+sinks = []
+
+# documents touched in current pass, see change_journal.py
+journal = None
+
+# patrol frontier of known topics, see --revisit-budget
+revisit = None
+
+# failed topics, see retry_topics()
+retries = None
+
+# topics crawled here or on other nodes, see --seen-filter
+seen = None
 
 
 def print_err(err_str: str):
@@ -40,13 +55,25 @@ def print_err(err_str: str):
         print(vt100_RESET)
 
 
+@instrument("rate_wait")
+def wait_for_rate():
+    if revisit is not None:
+        # every request of a patrol counts against --revisit-budget
+        revisit.spend()
+
+
 def curl(sub_url: str, c, post=None):
-    ua = UserAgent()
+    wait_for_rate()
+    return perform_curl(sub_url, c, post)
+
+
+@instrument("curl")
+def perform_curl(sub_url: str, c, post=None):
     buf = BytesIO()
     print(f"[curl] {sub_url}")
     url = f"{root_url}{sub_url}"
     url = url.encode("iso-8859-1")
-    c.setopt(c.HTTPHEADER, [f"User-agent: {ua.random}"])
+    c.setopt(c.HTTPHEADER, [f"User-agent: {random_user_agent()}"])
     c.setopt(c.URL, url)
     c.setopt(c.WRITEFUNCTION, buf.write)
     c.setopt(c.FOLLOWLOCATION, True)
@@ -54,27 +81,22 @@ def curl(sub_url: str, c, post=None):
     if post is not None:
         c.setopt(c.POST, 1)
         c.setopt(c.POSTFIELDS, urlencode(post))
-    errs = 0
-    while True:
-        try:
-            c.perform()
-        except (KeyboardInterrupt, SystemExit):
-            print("user aborting...")
-            raise
-        except Exception:
-            errs = errs + 1
-            if errs > 3:
-                buf.close()
-                raise
-            print("[curl] try again...")
-            continue
-        break
+    try:
+        c.perform()
+    except (KeyboardInterrupt, SystemExit):
+        print("user aborting...")
+        raise
+    except Exception:
+        # not trying again here, failed topics are retried later
+        buf.close()
+        raise
     res_str = buf.getvalue()
     buf.close()
     return res_str
 
 
 def parse_op_name(obj):
+    from slimit import ast
     if isinstance(obj, ast.DotAccessor):
         if isinstance(obj.node, ast.Identifier):
             l = f"{obj.node.value}.{obj.identifier.value}"
@@ -106,6 +128,7 @@ def convert_canonical_tex(s: str) -> str:
 
 
 def parse_node(node):
+    from slimit import ast
     ret = {}
     if hasattr(node, "value") or isinstance(node, ast.DotAccessor):
         return parse_op_name(node)
@@ -137,9 +160,11 @@ def parse_node(node):
     return ret
 
 
+@instrument("get_aops_data")
 def get_aops_data(page):
+    from bs4 import BeautifulSoup
     s = BeautifulSoup(page, "html.parser")
-    parser = slimit_parser
+    parser = get_parser()
     for script in s.findAll("script"):
         if "AoPS.bootstrap_data" in script.string:
             try:
@@ -152,51 +177,103 @@ def get_aops_data(page):
     return None
 
 
-def crawl_topic_page(sub_url, category_id, topic_id, c, extra_opt):
-    try:
-        topic_page = curl(sub_url, c)
-    except Exception:
-        raise
-
+@instrument("parse_topic_page")
+def parse_topic_page(topic_page: bytes):
     parsed = get_aops_data(topic_page)
     topic_data = parsed["AoPS.bootstrap_data"]["preload_cmty_data"]["topic_data"]
     session_data = parsed["AoPS.session"]
 
-    # get title
-    title = html.unescape(topic_data["topic_title"])
-
-    num_posts = int(topic_data["num_posts"])
-    posts_data_tmp = topic_data["posts_data"]
-    posts_data = []
-
     # now this is a bit tricky, but if there are more posts
     # than we received, AoPS sens first 15 and last 15 posts,
     # remove all posts that should be shown only from the end
-    for post in posts_data_tmp:
+    posts_data = []
+    for post in topic_data["posts_data"]:
         if post["show_from_start"] == "true":
             posts_data.append(post)
 
+    # only what is needed further, the parsed page can be huge
+    return {
+        "title": html.unescape(topic_data["topic_title"]),
+        "num_posts": int(topic_data["num_posts"]),
+        "posts_data": posts_data,
+        "user_id": session_data["user_id"],
+        "session_id": session_data["id"],
+    }
+
+
+def topic_chunk(category_id, topic_id, title, first_post, posts):
+    # (file_path, url, topic_txt) of a chunk of posts, named by its first
+    post_number = first_post["post_number"]
+    post_id = first_post["post_id"]
+    # compose title
+    head = title
+    if post_number != "1":
+        head += f" (posts after #{post_number})"
+    topic_txt = "".join([head, "\n\n", *posts])
+    post_url = f"/community/c{category_id}h{topic_id}p{post_id}"
+    file_path = get_file_path(category_id, topic_id, post_id)
+    return file_path, root_url + post_url, topic_txt
+
+
+def fetch_topic(sub_url, category_id, topic_id, c, extra_opt, offload):
+    """
+    Download a topic and yield (file_path, url, topic_txt) for each
+    chunk of posts, TeX is not yet normalized. Page parsing is done by
+    offload(func, arg), see crawl_pipeline.py.
+
+    A chunk is a page of posts as fetched, or, with --chunk-posts or
+    --chunk-bytes, at most that many posts or (about) bytes. Chunks are
+    yielded as soon as they are complete, so however long the topic,
+    only one chunk and one page of posts are held at a time.
+    """
+    topic = offload(parse_topic_page, curl(sub_url, c))
+    title = topic["title"]
+    num_posts = topic["num_posts"]
+    posts_data = topic["posts_data"]
+    user_id, session_id = topic["user_id"], topic["session_id"]
+    del topic
+    max_posts = extra_opt["chunk-posts"]
+    max_bytes = extra_opt["chunk-bytes"]
+
+    # the whole topic is one document to the revisit scheduler
+    requests = 1
+    digest = []
+
+    def add_digest(chunk):
+        # only imported with --revisit-budget
+        if revisit is not None:
+            from revisit_scheduler import content_hash
+            digest.append(content_hash(chunk[2]))
+
+    # posts of the chunk being assembled
+    first_post, posts, chunk_bytes = None, [], 0
     fetched_posts = 0
     while fetched_posts < num_posts and (len(posts_data) > 0):
-        post_number = posts_data[0]["post_number"]
-        post_id = posts_data[0]["post_id"]
-        # compose title
-        topic_txt = title
-        if post_number != "1":
-            topic_txt += f" (posts after #{post_number})"
-        topic_txt += "\n\n"
-        # get posts
         for post in posts_data:
-            topic_txt += f"{post['post_canonical']}\n\n"
-        # save posts
-        post_url = f"/community/c{category_id}h{topic_id}p{post_id}"
-        full_url = root_url + post_url
-        file_path = get_file_path(category_id, topic_id, post_id)
-        process_topic(file_path, topic_txt, full_url, extra_opt)
+            if first_post is None:
+                first_post = post
+            posts.append(f"{post['post_canonical']}\n\n")
+            if max_bytes > 0:
+                chunk_bytes += len(posts[-1].encode("utf-8"))
+            if ((max_posts > 0 and len(posts) >= max_posts) or
+                    (max_bytes > 0 and chunk_bytes >= max_bytes)):
+                chunk = topic_chunk(
+                    category_id, topic_id, title, first_post, posts
+                )
+                add_digest(chunk)
+                yield chunk
+                first_post, posts, chunk_bytes = None, [], 0
 
         # keep track of where we are
         fetched_posts += len(posts_data)
 
+        if max_posts <= 0 and max_bytes <= 0 and len(posts) > 0:
+            # one chunk per page
+            chunk = topic_chunk(category_id, topic_id, title, first_post, posts)
+            add_digest(chunk)
+            yield chunk
+            first_post, posts = None, []
+
         if fetched_posts < num_posts:
             # it is not ending, we need to request for more posts...
             postfields = {
@@ -208,49 +285,46 @@ def crawl_topic_page(sub_url, category_id, topic_id, c, extra_opt):
                 "num_to_fetch": 50,
                 "a": "fetch_posts_for_topic",
                 "aops_logged_in": "false",
-                "aops_user_id": session_data["user_id"],
-                "aops_session_id": session_data["id"],
+                "aops_user_id": user_id,
+                "aops_session_id": session_id,
             }
 
             sub_url = "/m/community/ajax.php"
             topic_page = curl(sub_url, c, post=postfields)
+            requests += 1
             parsed = json.loads(topic_page.decode("utf-8"))
             posts_data = parsed["response"]["posts"]
             # sleep to avoid over-frequent request.
-            time.sleep(0.6)
-
-    return topic_txt
-
-
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise Exception("mkdir needs permission")
-
-
-def save_preview(path: str, topic_txt: str, url: str):
-    # put preview into HTML template
-    f = open("template.html", "r")
-    fmt_str = f.read()
-    f.close()
-    topic_txt = topic_txt.replace("\n", "</br>")
-    preview = fmt_str.replace("{PREVIEW}", topic_txt)
-    preview = preview.replace("{URL}", url)
-    # save preview
-    with open(path, "w", encoding="utf8") as f:
-        f.write(preview)
+            time.sleep(extra_opt["delay"])
+
+    if len(posts) > 0:
+        # the rest of a fixed-size chunk
+        chunk = topic_chunk(category_id, topic_id, title, first_post, posts)
+        add_digest(chunk)
+        yield chunk
+
+    if revisit is not None:
+        from revisit_scheduler import content_hash
+        revisit.record(
+            topic_key(category_id, topic_id),
+            f"/community/c{category_id}h{topic_id}",
+            content_hash(" ".join(digest)), cost=requests
+        )
 
 
-def save_json(path: str, topic_txt, url):
-    with open(path, "w") as f:
-        f.write(json.dumps({"url": url, "text": topic_txt}, sort_keys=True))
+@instrument("crawl_topic_page")
+def crawl_topic_page(sub_url, category_id, topic_id, c, extra_opt):
+    topic_txt = None
+    for file_path, full_url, topic_txt in fetch_topic(
+        sub_url, category_id, topic_id, c, extra_opt, call_inline
+    ):
+        process_topic(file_path, topic_txt, full_url, extra_opt)
+    return topic_txt
 
 
 def get_curl():
+    import pycurl
+    import certifi
     c = pycurl.Curl()
     c.setopt(c.CONNECTTIMEOUT, 8)
     c.setopt(c.TIMEOUT, 10)
@@ -267,7 +341,7 @@ def list_category_topics(category, newest, oldest, c):
     # first access the page to acquire session id
     sub_url = "/community/"
 
-    community_page = curl(sub_url, c)
+    community_page = retry_soon(curl, sub_url, c)
 
     parsed = get_aops_data(community_page)
     session = parsed["AoPS.session"]
@@ -308,7 +382,7 @@ def list_category_topics(category, newest, oldest, c):
         }
 
         try:
-            navi_page = curl(sub_url, c, post=postfields)
+            navi_page = retry_soon(curl, sub_url, c, post=postfields)
             parsed = json.loads(navi_page.decode("utf-8"))
 
             resp = parsed["response"]
@@ -326,73 +400,239 @@ def list_category_topics(category, newest, oldest, c):
             yield (category, None, e)
 
 
+def topic_key(category_id, topic_id) -> str:
+    return f"c{category_id}h{topic_id}"
+
+
 def get_file_path(category_id, topic_id, post_id):
     directory = f"./tmp/{topic_id % DIVISIONS}"
     return f"{directory}/{file_prefix}-c{category_id}h{topic_id}p{post_id}"
 
 
-def process_topic(file_path: str, topic_txt: str, url: str, extra_opt):
-    try:
-        mkdir_p(os.path.dirname(file_path))
-    except Exception:
-        raise
+def normalize_topic_tex(topic_txt: str) -> str:
     # process TeX mode pieces
-    topic_txt = convert_canonical_tex(topic_txt)
-    topic_txt = replace_display_tex(topic_txt)
-    topic_txt = replace_inline_tex(topic_txt)
-    topic_txt = replace_dollar_tex(topic_txt)
-
-    # do not touch time stamp if previously
-    # an identical file already exists.
-    jsonfile = f"{file_path}.json"
-    if os.path.isfile(jsonfile):
-        print(f"[exists]{jsonfile}")
-        save_json(f"{file_prefix}.tmp", topic_txt, url)
-        if filecmp.cmp(f"{file_prefix}.tmp", jsonfile):
-            # two files are identical, do not touch
-            print("[identical, no touch]")
-            return
-        else:
-            print("[overwrite]")
+    with timed("replace_tex"):
+        topic_txt = convert_canonical_tex(topic_txt)
+        topic_txt = replace_display_tex(topic_txt)
+        topic_txt = replace_inline_tex(topic_txt)
+        topic_txt = replace_dollar_tex(topic_txt)
+    return topic_txt
+
+
+def save_topic(file_path: str, topic_txt: str, url: str):
+    doc = {"url": url, "text": topic_txt}
+    action, src_id = write_to_sinks(sinks, file_path, doc)
+    if journal is not None:
+        journal.record(action, file_path, src_id)
+    incr(f"docs_{action}")
+    return action
+
+
+@instrument("process_topic")
+def process_topic(file_path: str, topic_txt: str, url: str, extra_opt):
+    topic_txt = normalize_topic_tex(topic_txt)
+    return save_topic(file_path, topic_txt, url)
+
+
+# stages of crawl_pipeline.Pipeline, see -j option
+def fetch_topic_item(item, offload):
+    yield from fetch_topic(
+        item["sub_url"], item["category"], item["topic_id"], get_curl(),
+        item["extra_opt"], offload
+    )
+    # sleep to avoid over-frequent request.
+    time.sleep(item["extra_opt"]["delay"])
+
+
+def extract_topic(chunk):
+    file_path, full_url, topic_txt = chunk
+    return file_path, full_url, normalize_topic_tex(topic_txt)
+
+
+def write_topic(item, result):
+    file_path, full_url, topic_txt = result
+    save_topic(file_path, topic_txt, full_url)
+
+
+def fail_topic(item, err):
+    retry_later(item, err)
+
+
+def retry_later(item, err):
+    # the crawl goes on, the topic is retried later, see retry_topics()
+    print_err(f"topic {item['sub_url']} ({err})")
+    key = topic_key(item["category"], item["topic_id"])
+    retries.add(key, {
+        "category": item["category"], "topic_id": item["topic_id"],
+        "sub_url": item["sub_url"]
+    }, str(err))
+
 
-    # two files are different, save files
-    save_json(jsonfile, topic_txt, url)
-    if extra_opt["save-preview"]:
-        save_preview(f"{file_path}.html", topic_txt, url)
+def log_topic(category, topic_id):
+    # log crawled topics
+    page_log = open(f"{file_prefix}.log", "a")
+    page_log.write(f"category {category}, topic_id: {topic_id} \n")
+    page_log.close()
+
+
+def done_topic(item):
+    log_topic(item["category"], item["topic_id"])
+    if item.get("retry"):
+        retries.done(topic_key(item["category"], item["topic_id"]))
 
 
 def crawl_category_topics(category, newest, oldest, extra_opt):
     c = get_curl()
+    pipeline = extra_opt["pipeline"]
 
     succ_topics = 0
     for category, topic, e in list_category_topics(category, newest, oldest, c):
         if e is not None:
             print_err(f"category {category} error: {e}")
             break
+        key = topic_key(category, topic["topic_id"])
+        # a patrol fetches new posts of known topics, including ours
+        # in the filter, so it is only consulted otherwise.
+        if (seen is not None and not extra_opt["patrol"]
+                and f"{file_prefix}-{key}" in seen):
+            print("[seen, skip]", key)
+            incr("docs_seen")
+            succ_topics += 1
+            continue
+        if revisit is not None:
+            if revisit.known(key):
+                # known topics are revisited by the scheduler, see
+                # revisit_topics(), unless there are new posts.
+                revisit.hint(key, int(topic["last_post_time"]))
+                succ_topics += 1
+                continue
+        topic_id = topic["topic_id"]
+        sub_url = f"/community/c{category}h{topic_id}"
+        item = {"category": category, "topic_id": topic_id, "sub_url": sub_url}
+        if pipeline is not None:
+            pipeline.submit(dict(item, extra_opt=extra_opt))
+            continue
         try:
-            topic_id = topic["topic_id"]
-            sub_url = f"/community/c{category}h{topic_id}"
             crawl_topic_page(sub_url, category, topic_id, get_curl(), extra_opt)
         except (KeyboardInterrupt, SystemExit):
             print("[abort]")
             return "abort"
         except BaseException as e:
-            print_err(f"topic {sub_url} ({e})")
+            retry_later(item, e)
             continue
 
         # count on success
         succ_topics += 1
 
         # sleep to avoid over-frequent request.
-        time.sleep(0.6)
+        time.sleep(extra_opt["delay"])
 
-        # log crawled topics
-        page_log = open(f"{file_prefix}.log", "a")
-        page_log.write(f'category {category}, topic_id: {topic["topic_id"]} \n')
-        page_log.close()
+        log_topic(category, topic["topic_id"])
+    if pipeline is not None:
+        try:
+            succ_topics += pipeline.join()
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            pipeline.abort()
+            return "abort"
     return "finish"
 
 
+def revisit_topics(extra_opt):
+    pipeline = extra_opt["pipeline"]
+    due = revisit.due()
+    print(vt100_BLUE)
+    print(f"[revisit] {len(due)} topics")
+    print(vt100_RESET)
+    for key, sub_url in due:
+        category, topic_id = map(int, re.match(r"c(\d+)h(\d+)", key).groups())
+        item = {"category": category, "topic_id": topic_id, "sub_url": sub_url}
+        if pipeline is not None:
+            pipeline.submit(dict(item, extra_opt=extra_opt))
+            continue
+        try:
+            crawl_topic_page(sub_url, category, topic_id, get_curl(), extra_opt)
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            return "abort"
+        except BaseException as e:
+            retry_later(item, e)
+            continue
+
+        # sleep to avoid over-frequent request.
+        time.sleep(extra_opt["delay"])
+
+        log_topic(category, topic_id)
+    if pipeline is not None:
+        try:
+            pipeline.join()
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            pipeline.abort()
+            return "abort"
+    return "finish"
+
+
+def retry_topics(extra_opt, until=None):
+    """
+    Try again the failed topics due by `until` (default: now), those
+    failing again go back to the retry queue with a longer delay.
+    """
+    due = retries.due(until)
+    if len(due) == 0:
+        return "finish"
+    pipeline = extra_opt["pipeline"]
+    print(vt100_BLUE)
+    print(f"[retry] {len(due)} failed topics")
+    print(vt100_RESET)
+    for key, item in due:
+        if pipeline is not None:
+            pipeline.submit(dict(item, extra_opt=extra_opt, retry=True))
+            continue
+        try:
+            crawl_topic_page(
+                item["sub_url"], item["category"], item["topic_id"],
+                get_curl(), extra_opt
+            )
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            return "abort"
+        except BaseException as e:
+            retry_later(item, e)
+            continue
+        retries.done(key)
+
+        # sleep to avoid over-frequent request.
+        time.sleep(extra_opt["delay"])
+
+        log_topic(item["category"], item["topic_id"])
+    if pipeline is not None:
+        try:
+            pipeline.join()
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            pipeline.abort()
+            return "abort"
+    return "finish"
+
+
+def drain_retries(extra_opt):
+    # retry all pending topics now, then those failing again when due
+    until = float("inf")
+    while True:
+        r = retry_topics(extra_opt, until)
+        if r == "abort":
+            return r
+        next_due = retries.next_due()
+        if next_due is None:
+            return "finish"
+        wait = next_due - time.time()
+        if wait > 0:
+            print(f"[retry] next retry in {wait:.0f} sec")
+            time.sleep(wait)
+        until = None
+
+
 def help(arg0):
     print(
         "DESCRIPTION: crawler script for artofproblemsolving.com."
@@ -402,9 +642,37 @@ def help(arg0):
         "[-o | --oldest <days>] "
         "[-c | --category <cnum>] "
         "[--patrol] "
+        "[--revisit-budget <requests per hour>] "
+        "[--seen-filter <filter file>] "
         "[--save-preview] "
         "[--hook-script <script name>] "
+        "[--journal-keep <journals>] "
+        f"[--sink {' | '.join(SINK_NAMES)} ] "
+        "[--sink-config <feeder config>] "
+        "[--sink-corpus <config section>] "
+        f"[--dedup {' | '.join(DEDUP_MODES)} ] "
+        "[--dedup-threshold <similarity>] "
+        "[--dedup-index <sqlite file>] "
+        "[--metrics-port <port>] "
+        "[--metrics-json <file>] "
+        "[--profile <directory>] "
+        "[--root-url <url>] "
+        "[--delay <seconds>] "
+        "[-j | --jobs <extraction processes>] "
+        "[--fetchers <download threads>] "
+        "[--chunk-posts <posts>] "
+        "[--chunk-bytes <bytes>] "
+        "[--retry-failed] "
         "[-t | --topic <topic id>] "
+        "\n\n"
+        "--seen-filter skips topics in a filter made by seen_filter.py, "
+        "e.g., crawled by other nodes, except with --patrol."
+        "\n"
+        "Topics are saved in chunks of one page of posts each, or of at "
+        "most --chunk-posts posts or --chunk-bytes bytes."
+        "\n"
+        "Failed topics are retried later with backoff, --retry-failed only "
+        "retries them, until none is left."
         "\n"
     )
     print(
@@ -431,22 +699,68 @@ def main(args):
     try:
         opts, _ = getopt.getopt(
             argv,
-            "n:o:c:t:h",
+            "n:o:c:t:j:h",
             [
                 "newest=",
                 "oldest=",
                 "category=",
                 "topic=",
                 "patrol",
+                "revisit-budget=",
+                "seen-filter=",
                 "save-preview",
                 "hook-script=",
+                "journal-keep=",
+                "sink=",
+                "sink-config=",
+                "sink-corpus=",
+                "dedup=",
+                "dedup-threshold=",
+                "dedup-index=",
+                "metrics-port=",
+                "metrics-json=",
+                "profile=",
+                "root-url=",
+                "delay=",
+                "jobs=",
+                "fetchers=",
+                "chunk-posts=",
+                "chunk-bytes=",
+                "retry-failed",
             ],
         )
     except Exception:
         help(args[0])
 
     # default arguments
-    extra_opt = {"hookscript": "", "patrol": False, "save-preview": False}
+    global root_url
+    global sinks
+    global journal
+    global revisit
+    global retries
+    global seen
+    extra_opt = {
+        "hookscript": "",
+        "journal-keep": 100,
+        "patrol": False,
+        "revisit-budget": 0,
+        "save-preview": False,
+        "sinks": [],
+        "sink-config": os.path.join(
+            os.path.dirname(__file__), "feeder", "feeder.ini"
+        ),
+        "sink-corpus": "crawler",
+        "dedup": None,
+        "dedup-threshold": 0.95,
+        "dedup-index": "./near_dup.sqlite",
+        "delay": 0.6,
+        "jobs": 0,
+        "fetchers": 1,
+        "pipeline": None,
+        "chunk-posts": 0,
+        "chunk-bytes": 0,
+        "retry-failed": False,
+    }
     category = -1
     topic = -1
     newest = 0
@@ -467,41 +781,151 @@ def main(args):
             continue
         elif opt in ("--patrol"):
             extra_opt["patrol"] = True
+        elif opt == "--revisit-budget":
+            extra_opt["revisit-budget"] = float(arg)
+        elif opt == "--seen-filter":
+            # imported here, most runs do not share a seen filter
+            from seen_filter import SeenFilter
+            seen = SeenFilter(arg)
         elif opt in ("--save-preview"):
             extra_opt["save-preview"] = True
         elif opt in ("--hook-script"):
             extra_opt["hookscript"] = arg
+        elif opt == "--journal-keep":
+            extra_opt["journal-keep"] = int(arg)
+        elif opt == "--sink":
+            if arg not in SINK_NAMES:
+                help(args[0])
+            extra_opt["sinks"].append(arg)
+        elif opt == "--sink-config":
+            extra_opt["sink-config"] = arg
+        elif opt == "--sink-corpus":
+            extra_opt["sink-corpus"] = arg
+        elif opt == "--dedup":
+            if arg not in DEDUP_MODES:
+                help(args[0])
+            extra_opt["dedup"] = arg
+        elif opt == "--dedup-threshold":
+            extra_opt["dedup-threshold"] = float(arg)
+        elif opt == "--dedup-index":
+            extra_opt["dedup-index"] = arg
+        elif opt == "--metrics-port":
+            serve_metrics(int(arg))
+        elif opt == "--metrics-json":
+            dump_json_periodically(arg)
+        elif opt == "--profile":
+            enable_profile(arg)
+        elif opt == "--root-url":
+            # e.g., a local replay server, see bench/
+            root_url = arg
+        elif opt == "--delay":
+            extra_opt["delay"] = float(arg)
+        elif opt in ("-j", "--jobs"):
+            extra_opt["jobs"] = int(arg)
+        elif opt == "--fetchers":
+            extra_opt["fetchers"] = int(arg)
+        elif opt == "--chunk-posts":
+            extra_opt["chunk-posts"] = int(arg)
+        elif opt == "--chunk-bytes":
+            extra_opt["chunk-bytes"] = int(arg)
+        elif opt == "--retry-failed":
+            extra_opt["retry-failed"] = True
         else:
             help(args[0])
 
+    crawling = category > 0 and topic <= 0 or extra_opt["retry-failed"]
+    if crawling and extra_opt["jobs"] > 0:
+        # download, extract and write topics in a staged pipeline, the
+        # worker processes are forked before sinks start any thread (the
+        # metrics lock is reset in them, see stage_metrics.reset_lock).
+        from crawl_pipeline import Pipeline
+        extra_opt["pipeline"] = Pipeline(
+            fetch_topic_item, extract_topic, write_topic, fail_topic,
+            done=done_topic,
+            jobs=extra_opt["jobs"], fetchers=extra_opt["fetchers"]
+        )
+    sinks = make_sinks(
+        extra_opt["sinks"] or ["fs"], file_prefix, extra_opt["save-preview"],
+        extra_opt["sink-config"], extra_opt["sink-corpus"],
+        dedup_options(extra_opt)
+    )
+
     if topic > 0:
         sub_url = f"/community/c{category}h{topic}"
         crawl_topic_page(sub_url, category, topic, get_curl(), extra_opt)
+        close_sinks(sinks)
         exit(0)
 
-    if category > 0:
-        while True:
-            # crawling newest pages
-            try:
-                r = crawl_category_topics(category, newest, oldest, extra_opt)
-            except Exception as e:
-                print_err(str(e))
-                quit(1)
-
-            if r == "abort":
-                break
-
-            # now it is the time to invoke hookscript.
-            if extra_opt["hookscript"]:
-                os.system(extra_opt["hookscript"])
-
-            if extra_opt["patrol"]:
-                # if patrol mode is enabled, loop forever.
-                pass
-            else:
-                break
-    else:
-        help(args[0])
+    try:
+        if extra_opt["retry-failed"]:
+            # only drain the retry queue
+            journal = ChangeJournal(
+                "./journal", file_prefix, keep=extra_opt["journal-keep"]
+            )
+            retries = RetryQueue(f"{file_prefix}-retry.sqlite")
+            drain_retries(extra_opt)
+        elif category > 0:
+            journal = ChangeJournal(
+                "./journal", file_prefix, keep=extra_opt["journal-keep"]
+            )
+            retries = RetryQueue(f"{file_prefix}-retry.sqlite")
+            if extra_opt["patrol"] and extra_opt["revisit-budget"] > 0:
+                from revisit_scheduler import RevisitScheduler
+                revisit = RevisitScheduler(
+                    f"{file_prefix}-revisit.sqlite", extra_opt["revisit-budget"]
+                )
+            while True:
+                # crawling newest pages
+                try:
+                    r = crawl_category_topics(category, newest, oldest, extra_opt)
+                except Exception as e:
+                    print_err(str(e))
+                    quit(1)
+
+                if r == "abort":
+                    break
+
+                # spend the revisit budget on topics most likely changed by now
+                if revisit is not None:
+                    r = revisit_topics(extra_opt)
+                    if r == "abort":
+                        break
+
+                r = retry_topics(extra_opt)
+                if r == "abort":
+                    break
+
+                # make this pass visible downstream before the hook script.
+                flush_sinks(sinks)
+
+                # now it is the time to invoke hookscript,
+                # with the change journal of this pass as argument.
+                journal_path = journal.rotate()
+                if extra_opt["hookscript"]:
+                    hookscript = extra_opt["hookscript"]
+                    os.system(f"{hookscript} {shlex.quote(journal_path)}")
+
+                if extra_opt["patrol"]:
+                    # if patrol mode is enabled, loop forever.
+                    pass
+                else:
+                    break
+        else:
+            help(args[0])
+    finally:
+        # also on errors (quit), so that the pending indexd batch and
+        # segment lines are not lost
+        if extra_opt["pipeline"] is not None:
+            extra_opt["pipeline"].close()
+        close_sinks(sinks)
+        if journal is not None:
+            journal.close()
+        if retries is not None:
+            retries.report()
+            retries.close()
+        if revisit is not None:
+            revisit.report()
+            revisit.close()
 
 
 if __name__ == "__main__":
@@ -1,22 +1,33 @@
 #!/usr/bin/python3
+# annotations refer to lazily imported pycurl and bs4
+from __future__ import annotations
 import time
-import pycurl
-import certifi
 import os
-import errno
-import code
 import re
-import json
 import sys
+import shlex
 import getopt
-import filecmp
 import math
+import threading
+from post_sink import SINK_NAMES, DEDUP_MODES, dedup_options
+from post_sink import make_sinks, write_to_sinks, flush_sinks, close_sinks
+from change_journal import ChangeJournal
+from rate_limit import host_bucket
+from egress_pool import EgressPool
+from retry_queue import RetryQueue, retry_soon
+from stage_metrics import timed, instrument, incr
+from stage_metrics import serve_metrics, dump_json_periodically, enable_profile
 from replace_post_tex import replace_dollar_tex
 from replace_post_tex import replace_display_tex
 from replace_post_tex import replace_inline_tex
 from io import BytesIO
-from bs4 import BeautifulSoup
-from typing import Dict, List, Tuple, Union
+from urllib.parse import urlsplit
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+if TYPE_CHECKING:
+    # only for annotations, imported lazily where they are used
+    import pycurl
+    from bs4 import BeautifulSoup
 
 SE_SITE_ROOT = {
     "mse": "https://math.stackexchange.com",
@@ -27,8 +38,7 @@ SE_SITE_ROOT = {
 }
 
 # default target StackExchange site
-file_prefix = "mse"
-root_url = SE_SITE_ROOT[file_prefix]
+DEFAULT_SITE = "mse"
 
 vt100_BLUE = "\033[94m"
 vt100_WARNING = "\033[93m"
@@ -36,6 +46,13 @@ vt100_RESET = "\033[0m"
 DIVISIONS = 500
 PAGESIZE = 30
 
+# guards appending to gap maps, see record_gaps()
+gaps_lock = threading.Lock()
+
+# optional pool of egress routes, see --egress and egress_pool.py
+egress = None
+THROTTLE_CODES = (429, 503)
+
 
 def print_err(err_str: str):
     with open("error.log", "a") as f:
@@ -45,34 +62,116 @@ def print_err(err_str: str):
         print(vt100_RESET)
 
 
-def curl(sub_url: str, c):
+def make_site(prefix: str, root_url: str, extra_opt):
+    """
+    Everything about one crawled site, so that sites can be crawled
+    concurrently. sinks and journal are set up by open_site().
+    """
+    delay = extra_opt["delay"]
+    return {
+        "prefix": prefix,
+        "root_url": root_url,
+        # minimal interval between requests to the same host
+        "bucket": host_bucket(root_url, 1.0 / delay if delay > 0 else 0),
+        "sinks": [],
+        "journal": None,
+        # IDs known not to be questions, see load_gap_map()
+        "gaps": None,
+        # patrol frontier, see --revisit-budget
+        "revisit": None,
+        # failed posts, see retry_posts()
+        "retry": None,
+    }
+
+
+def open_site(site, extra_opt, if_save_preview):
+    site["sinks"] = make_sinks(
+        extra_opt["sinks"] or ["fs"], site["prefix"], if_save_preview,
+        extra_opt["sink-config"], extra_opt["sink-corpus"],
+        dedup_options(extra_opt)
+    )
+    site["journal"] = ChangeJournal(
+        "./journal", site["prefix"], keep=extra_opt["journal-keep"]
+    )
+    site["retry"] = RetryQueue(retry_path(site))
+
+
+def close_site(site):
+    close_sinks(site["sinks"])
+    site["journal"].close()
+    site["retry"].report()
+    site["retry"].close()
+    if site["revisit"] is not None:
+        site["revisit"].report()
+        site["revisit"].close()
+
+
+def revisit_path(site) -> str:
+    return f"{site['prefix']}-revisit.sqlite"
+
+
+def retry_path(site) -> str:
+    return f"{site['prefix']}-retry.sqlite"
+
+
+@instrument("rate_wait")
+def wait_for_rate(site):
+    if site["revisit"] is not None:
+        # every request of a patrol counts against --revisit-budget
+        site["revisit"].spend()
+    if egress is None:
+        site["bucket"].acquire()
+        return None
+    return egress.acquire(site["root_url"])
+
+
+def curl(site, sub_url: str, c):
+    if egress is None:
+        wait_for_rate(site)
+        with timed("curl"):
+            return perform_curl(site, sub_url, c)
+
+    # as long as the host throttles a route, retry from another one
+    for _ in range(len(egress.routes) + 1):
+        route = wait_for_rate(site)
+        if getattr(c, "egress_route", None) is not route:
+            # start from a clean handle, a source address can not be unset
+            c.reset()
+            setup_curl(c)
+            route.configure(c)
+            c.egress_route = route
+        try:
+            with timed("curl"):
+                page = perform_curl(site, sub_url, c)
+        except Exception:
+            egress.failed(route)
+            raise
+        if c.getinfo(c.RESPONSE_CODE) in THROTTLE_CODES:
+            egress.throttled(route)
+            continue
+        egress.succeeded(route)
+        return page
+    raise Exception(f"throttled on every egress route: {sub_url}")
+
+
+def perform_curl(site, sub_url: str, c):
     buf = BytesIO()
-    url = f"{root_url}{sub_url}"
+    url = f"{site['root_url']}{sub_url}"
     print(f"[curl] {url}")
     url = url.encode("iso-8859-1")
-    c.setopt(c.HTTPHEADER, [f"User-agent: curl/7.77.0"])
+    c.setopt(c.HTTPHEADER, ["User-agent: curl/7.77.0"])
     c.setopt(c.URL, url)
     c.setopt(c.WRITEFUNCTION, buf.write)
     #c.setopt(c.VERBOSE, True)
-    retry_cnt = 0
-    while True:
-        try:
-            c.perform()
-        except (KeyboardInterrupt, SystemExit):
-            print("user aborting...")
-            raise
-        except Exception as err:
-            if retry_cnt < 10:
-                retry_cnt += 1
-            else:
-                buf.close()
-                raise
-            wait_time = retry_cnt * 10.0
-            print(err)
-            print(f"[curl] sleep {wait_time} and try again...")
-            time.sleep(wait_time)
-            continue
-        break
+    try:
+        c.perform()
+    except (KeyboardInterrupt, SystemExit):
+        print("user aborting...")
+        raise
+    except Exception:
+        # not waiting here, failed posts are retried later
+        buf.close()
+        raise
     res_str = buf.getvalue()
     buf.close()
     return res_str
@@ -95,11 +194,19 @@ def extract_comments_text(soup: BeautifulSoup) -> str:
     )
 
 
-def crawl_post_page(sub_url: str, c: pycurl.Curl) -> Tuple[str, List[str]]:
+@instrument("crawl_post_page")
+def crawl_post_page(
+    site, sub_url: str, c: pycurl.Curl
+) -> Tuple[str, List[str]]:
     try:
-        post_page = curl(sub_url, c)
+        post_page = curl(site, sub_url, c)
     except:
         raise
+    return parse_post_page(post_page)
+
+
+def parse_post_page(post_page: bytes) -> Tuple[str, List[str]]:
+    from bs4 import BeautifulSoup
     s = BeautifulSoup(post_page, "html.parser")
     # get title
     question_header = s.find(id="question-header")
@@ -136,53 +243,106 @@ def crawl_post_page(sub_url: str, c: pycurl.Curl) -> Tuple[str, List[str]]:
     return post_txt, taglist
 
 
-def mkdir_p(path: str):
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise Exception("mkdir needs permission")
-
-
-def save_preview(path: str, post_txt: str, url: str):
-    # put preview into HTML template
-    script_dir = os.path.dirname(__file__)
-    f = open(os.path.join(script_dir, "template.html"), "r")
-    fmt_str = f.read()
-    f.close()
-    post_txt = post_txt.replace("\n", "</br>")
-    preview = fmt_str.replace("{PREVIEW}", post_txt).replace("{URL}", url)
-    # save preview
-    with open(path, "w", encoding="utf8") as f:
-        f.write(preview)
-
-
-def save_json(path: str, post_txt: str, tags: List[str], url: str):
-    with open(path, "w") as f:
-        f.write(
-            json.dumps(
-                {"url": url, "tags": tags, "text": post_txt}, sort_keys=True
-            )
-        )
-
-
 def get_curl():
+    import pycurl
     c = pycurl.Curl()
+    setup_curl(c)
+    return c
+
+
+def setup_curl(c):
+    import certifi
     c.setopt(c.CONNECTTIMEOUT, 8)
     c.setopt(c.TIMEOUT, 10)
     c.setopt(c.CAINFO, certifi.where())
 
     # redirect on 3XX error
     c.setopt(c.FOLLOWLOCATION, 1)
-    return c
 
 
-def crawl_total_pages():
+def gap_map_path(site) -> str:
+    return f"{site['prefix']}-gaps.txt"
+
+
+def load_gap_map(site):
+    """
+    Question IDs are shared with answers, and deleted questions leave
+    holes, so most IDs of a range are not questions. They are cached in
+    a per-site gap map ("<id> <reason>" lines), so that later passes
+    over a range do not request them again.
+    """
+    gaps = {}
+    if os.path.isfile(gap_map_path(site)):
+        with open(gap_map_path(site), "r") as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) == 2:
+                    gaps[int(fields[0])] = fields[1]
+    site["gaps"] = gaps
+    return gaps
+
+
+def record_gaps(site, post_ids: List[int], reason: str):
+    with gaps_lock:
+        new_ids = [i for i in post_ids if i not in site["gaps"]]
+        if len(new_ids) == 0:
+            return
+        with open(gap_map_path(site), "a") as fh:
+            for post_id in new_ids:
+                site["gaps"][post_id] = reason
+                fh.write(f"{post_id} {reason}\n")
+
+
+def question_gap(post_id: int, c: pycurl.Curl) -> Union[str, None]:
+    # tell from the last response if post_id is not a question
+    status = c.getinfo(c.RESPONSE_CODE)
+    if status in (404, 410):
+        return "deleted"
+    effective_url = c.getinfo(c.EFFECTIVE_URL)
+    res = re.match(r"/questions/(\d+)", urlsplit(effective_url).path)
+    if res is None:
+        raise Exception(f"unexpected redirect to {effective_url}")
+    elif int(res.group(1)) != post_id:
+        # an answer ID redirects to its question
+        return "answer"
+    return None
+
+
+def question_url(site, post_id: int, post_page: bytes, c: pycurl.Curl) -> str:
+    # the slugged URL listing pages link to, so that a question has the
+    # same URL (to sinks, filters and shards) however it is crawled.
+    urls = [c.getinfo(c.EFFECTIVE_URL)]
+    res = re.search(rb'<link rel="canonical" href="([^"]+)"', post_page)
+    if res is not None:
+        urls.append(res.group(1).decode("utf-8"))
+    for url in urls:
+        res = re.match(rf"/questions/{post_id}/[^/]+$", urlsplit(url).path)
+        if res is not None:
+            return f"{site['root_url']}{res.group(0)}?noredirect=1"
+    return f"{site['root_url']}/questions/{post_id}?noredirect=1"
+
+
+def fetch_question(
+    site, post_id: int, c: pycurl.Curl
+) -> Tuple[Union[bytes, None], Union[str, None]]:
+    # return the question page and its URL, or (None, None) for a gap
+    post_page = curl(site, f"/questions/{post_id}?noredirect=1", c)
+    gap = question_gap(post_id, c)
+    if gap is not None:
+        print(f"[gap] {post_id} ({gap})")
+        record_gaps(site, [post_id], gap)
+        return None, None
+    # answers on this page are no questions, spare requests for them
+    answer_ids = re.findall(rb'data-answerid="(\d+)"', post_page)
+    record_gaps(site, [int(i) for i in answer_ids], "answer")
+    return post_page, question_url(site, post_id, post_page, c)
+
+
+def crawl_total_pages(site):
+    from bs4 import BeautifulSoup
     c = get_curl()
     try:
-        questions_page = curl('/questions?tab=newest', c)
+        questions_page = retry_soon(curl, site, '/questions?tab=newest', c)
         s = BeautifulSoup(questions_page, "html.parser")
         pagers = s.find("div", {"class": "pager"}).find_all('a')
         return int(pagers[-2].text)
@@ -191,14 +351,15 @@ def crawl_total_pages():
         print(err, file=sys.stderr)
         return 0
 
-def list_post_links(page: int, sortby, c: pycurl.Curl):
+def list_post_links(site, page: int, sortby, c: pycurl.Curl):
+    from bs4 import BeautifulSoup
     # sortby can be 'newest', 'active' etc.
     sub_url = f"/questions?pagesize={PAGESIZE}&sort={sortby}&page={page}"
 
     retry_cnt = 0
     while True:
         try:
-            navi_page = curl(sub_url, c)
+            navi_page = retry_soon(curl, site, sub_url, c)
         except Exception as err:
             yield (None, None, err)
         s = BeautifulSoup(navi_page, "html.parser")
@@ -209,9 +370,15 @@ def list_post_links(page: int, sortby, c: pycurl.Curl):
         if len(summary_tags) == 0:
             if retry_cnt < 60:
                 retry_cnt += 1
+            if egress is not None:
+                # take this route out of rotation, retry from another one
+                print("Request too frequent? Switch egress route ...")
+                egress.throttled(c.egress_route)
+                continue
             wait_time = retry_cnt * 10.0
             print(f"Request too frequent? Wait {wait_time} sec ...")
-            time.sleep(wait_time)
+            # hold back every request to this host, other hosts go on
+            site["bucket"].pause(wait_time)
         else:
             break
 
@@ -224,59 +391,116 @@ def list_post_links(page: int, sortby, c: pycurl.Curl):
         yield (div["id"], a_tag["href"], None)
 
 
-def get_file_path(post_id: int) -> str:
+def get_file_path(site, post_id: int) -> str:
 
     directory = f"./tmp/{post_id % DIVISIONS}"
-    return os.path.join(directory, file_prefix) + str(post_id)
+    return os.path.join(directory, site["prefix"]) + str(post_id)
+
+
+def seen_elsewhere(file_path: str, extra_opt) -> bool:
+    # crawled before, here or on another node, see --seen-filter, only
+    # consulted where existing files are skipped (--no-overwrite), the
+    # filter includes our own output, which --patrol has to refresh.
+    seen = extra_opt["seen"]
+    if seen is None or extra_opt["overwrite"]:
+        return False
+    elif os.path.basename(file_path) not in seen:
+        return False
+    print("[seen, skip]", file_path)
+    incr("docs_seen")
+    return True
+
+
+def normalize_post_tex(post_txt: str) -> str:
+    # process TeX mode pieces
+    with timed("replace_tex"):
+        post_txt = replace_display_tex(post_txt)
+        post_txt = replace_inline_tex(post_txt)
+        post_txt = replace_dollar_tex(post_txt)
+    return post_txt
 
 
+def save_post(
+    site, post_id: int, post_txt: str, taglist: List[str], url: str
+):
+    # decide sub-directory
+    file_path = get_file_path(site, post_id)
+    doc = {"url": url, "tags": taglist, "text": post_txt}
+    action, src_id = write_to_sinks(site["sinks"], file_path, doc)
+    if site["journal"] is not None:
+        site["journal"].record(action, file_path, src_id)
+    if site["revisit"] is not None:
+        from revisit_scheduler import content_hash
+        sub_url = url[len(site["root_url"]):]
+        site["revisit"].record(str(post_id), sub_url, content_hash(post_txt))
+    incr(f"docs_{action}")
+    return action
+
+
+@instrument("process_post")
 def process_post(
+    site,
     post_id: int,
     post_txt: str,
     taglist: List[str],
     url: str,
-    if_save_preview: bool,
 ):
-    # decide sub-directory
-    file_path = get_file_path(post_id)
-    try:
-        mkdir_p(os.path.dirname(file_path))
-    except:
-        raise
-    # process TeX mode pieces
-    post_txt = replace_display_tex(post_txt)
-    post_txt = replace_inline_tex(post_txt)
-    post_txt = replace_dollar_tex(post_txt)
-
-    # do not touch time stamp if previously
-    # an identical file already exists.
-    jsonfile = f"{file_path}.json"
-    if os.path.isfile(jsonfile):
-        print(f"[exists]{jsonfile}")
-        save_json(f"{file_prefix}.tmp", post_txt, taglist, url)
-        if filecmp.cmp(f"{file_prefix}.tmp", jsonfile):
-            # two files are identical, do not touch
-            print("[identical, no touch]")
-            return
-        else:
-            print("[overwrite]")
+    post_txt = normalize_post_tex(post_txt)
+    return save_post(site, post_id, post_txt, taglist, url)
+
+
+# stages of crawl_pipeline.Pipeline, see -j option
+def fetch_post(item, offload):
+    if item["by_id"]:
+        post_page, url = fetch_question(item["site"], item["id"], get_curl())
+        if post_page is not None:
+            item["url"] = url
+            yield post_page
+    else:
+        yield curl(item["site"], item["sub_url"], get_curl())
+
+
+def extract_post(post_page: bytes) -> Tuple[str, List[str]]:
+    post_txt, taglist = parse_post_page(post_page)
+    # plain strings, tag elements would drag their whole soup along
+    taglist = [None if t is None else str(t) for t in taglist]
+    return normalize_post_tex(post_txt), taglist
+
+
+def write_post(item, result):
+    post_txt, taglist = result
+    save_post(item["site"], item["id"], post_txt, taglist, item["url"])
 
-    # two files are different, save files
-    save_json(jsonfile, post_txt, taglist, url)
-    if if_save_preview:
-        save_preview(f"{file_path}.html", post_txt, url)
+
+def fail_post(item, err):
+    retry_later(item["site"], item, err)
+
+
+def done_post(item):
+    if item.get("retry"):
+        item["site"]["retry"].done(str(item["id"]))
+
+
+def retry_later(site, item, err):
+    # the crawl goes on, the post is retried later, see retry_posts()
+    print_err(f"post {item['url']}: {err}")
+    item = {k: v for k, v in item.items() if k not in ("site", "retry")}
+    site["retry"].add(str(item["id"]), item, str(err))
 
 
 def crawl_pages(
-    sortby, start: int, end: int, extra_opt: Dict[str, Union[bool, str]]
+    site, sortby, start: int, end: int,
+    extra_opt: Dict[str, Union[bool, str]]
 ):
     c = get_curl()
+    pipeline = extra_opt["pipeline"]
     for page in range(start, end + 1):
         print(vt100_BLUE)
-        print(f"page#{page} in [{start}, {end}]  order by {sortby}")
+        print(f"[{site['prefix']}] page#{page} in [{start}, {end}]  "
+            f"order by {sortby}")
         print(vt100_RESET)
         succ_posts = 0
-        for div_id, sub_url, err in list_post_links(page, sortby, c):
+        for div_id, sub_url, err in list_post_links(site, page, sortby, c):
             if err is not None:
                 print_err(f"page {page}")
                 break
@@ -285,35 +509,328 @@ def crawl_pages(
                 print_err(f"div ID {div_id}")
                 continue
             ID = int(res.group(1))
-            file_path = get_file_path(ID)
+            file_path = get_file_path(site, ID)
+            if seen_elsewhere(file_path, extra_opt):
+                # count on success
+                succ_posts += 1
+                continue
             if os.path.isfile(file_path + ".json"):
                 if not extra_opt["overwrite"]:
                     print("[exists, skip]", file_path)
+                    site["journal"].record("unchanged", file_path)
                     # count on success
                     succ_posts += 1
                     continue
+            if site["revisit"] is not None and site["revisit"].known(str(ID)):
+                # known posts are revisited by the scheduler, see
+                # revisit_posts(), listing them as active is a hint.
+                if sortby == "active":
+                    site["revisit"].hint(str(ID))
+                succ_posts += 1
+                continue
+            sub_url = f"{sub_url}?noredirect=1"
+            url = f"{site['root_url']}{sub_url}"
+            item = {"id": ID, "sub_url": sub_url, "url": url, "by_id": False}
+            if pipeline is not None:
+                pipeline.submit(dict(item, site=site), group=site["prefix"])
+                continue
             try:
-                sub_url = f"{sub_url}?noredirect=1"
-                url = f"{root_url}{sub_url}"
-                post_txt, taglist = crawl_post_page(sub_url, get_curl())
-                process_post(
-                    ID, post_txt, taglist, url, extra_opt["save-preview"]
-                )
+                post_txt, taglist = crawl_post_page(site, sub_url, get_curl())
+                process_post(site, ID, post_txt, taglist, url)
             except (KeyboardInterrupt, SystemExit):
                 print("[abort]")
                 return "abort"
             except Exception as err:
-                print_err(f"post {url}: {err}")
+                retry_later(site, item, err)
                 continue
 
             # count on success
             succ_posts += 1
-
-            # sleep to avoid request too frequently.
-            time.sleep(1.5)
+        if pipeline is not None:
+            try:
+                succ_posts += pipeline.join(group=site["prefix"])
+            except (KeyboardInterrupt, SystemExit):
+                print("[abort]")
+                pipeline.abort()
+                return "abort"
         # log crawled page number
-        with open(f"{file_prefix}.log", "a") as page_log:
+        with open(f"{site['prefix']}.log", "a") as page_log:
             page_log.write(f"page {page}: {succ_posts} posts successful.\n")
+
+        # meanwhile, earlier failed posts may be due for another try
+        if retry_posts(site, extra_opt) == "abort":
+            return "abort"
+    return "finish"
+
+
+def revisit_posts(site, extra_opt):
+    c = get_curl()
+    pipeline = extra_opt["pipeline"]
+    due = site["revisit"].due()
+    print(vt100_BLUE)
+    print(f"[{site['prefix']}] revisiting {len(due)} posts")
+    print(vt100_RESET)
+    succ_posts = 0
+    for key, sub_url in due:
+        ID = int(key)
+        url = f"{site['root_url']}{sub_url}"
+        item = {"id": ID, "sub_url": sub_url, "url": url, "by_id": False}
+        if pipeline is not None:
+            pipeline.submit(dict(item, site=site), group=site["prefix"])
+            continue
+        try:
+            post_txt, taglist = crawl_post_page(site, sub_url, c)
+            process_post(site, ID, post_txt, taglist, url)
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            return "abort"
+        except Exception as err:
+            retry_later(site, item, err)
+            continue
+
+        # count on success
+        succ_posts += 1
+    if pipeline is not None:
+        try:
+            succ_posts += pipeline.join(group=site["prefix"])
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            pipeline.abort()
+            return "abort"
+    # log revisited posts
+    with open(f"{site['prefix']}.log", "a") as page_log:
+        page_log.write(f"revisit: {succ_posts} posts successful.\n")
+    return "finish"
+
+
+def crawl_id_range(site, begin_id: int, end_id: int, extra_opt):
+    c = get_curl()
+    pipeline = extra_opt["pipeline"]
+    print(vt100_BLUE)
+    print(f"[{site['prefix']}] question IDs in [{begin_id}, {end_id}]")
+    print(vt100_RESET)
+    succ_posts = 0
+    skipped = 0
+    for ID in range(begin_id, end_id + 1):
+        if ID in site["gaps"]:
+            skipped += 1
+            continue
+        file_path = get_file_path(site, ID)
+        if seen_elsewhere(file_path, extra_opt):
+            # count on success
+            succ_posts += 1
+            continue
+        if os.path.isfile(file_path + ".json"):
+            if not extra_opt["overwrite"]:
+                print("[exists, skip]", file_path)
+                site["journal"].record("unchanged", file_path)
+                # count on success
+                succ_posts += 1
+                continue
+        url = f"{site['root_url']}/questions/{ID}?noredirect=1"
+        item = {"id": ID, "url": url, "by_id": True}
+        if pipeline is not None:
+            pipeline.submit(dict(item, site=site), group=site["prefix"])
+            continue
+        try:
+            post_page, url = fetch_question(site, ID, c)
+            if post_page is None:
+                skipped += 1
+                continue
+            post_txt, taglist = parse_post_page(post_page)
+            process_post(site, ID, post_txt, taglist, url)
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            return "abort"
+        except Exception as err:
+            retry_later(site, item, err)
+            continue
+
+        # count on success
+        succ_posts += 1
+    if pipeline is not None:
+        try:
+            # gaps found by the pipeline are counted as successful here
+            succ_posts += pipeline.join(group=site["prefix"])
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            pipeline.abort()
+            return "abort"
+    # log crawled ID range
+    with open(f"{site['prefix']}.log", "a") as page_log:
+        page_log.write(
+            f"IDs [{begin_id}, {end_id}]: {succ_posts} posts successful, "
+            f"{skipped} gaps skipped.\n"
+        )
+    return "finish"
+
+
+def retry_posts(site, extra_opt, until=None):
+    """
+    Try again the failed posts due by `until` (default: now), those
+    failing again go back to the retry queue with a longer delay.
+    """
+    due = site["retry"].due(until)
+    if len(due) == 0:
+        return "finish"
+    c = get_curl()
+    pipeline = extra_opt["pipeline"]
+    print(vt100_BLUE)
+    print(f"[{site['prefix']}] retrying {len(due)} failed posts")
+    print(vt100_RESET)
+    succ_posts = 0
+    for key, item in due:
+        if pipeline is not None:
+            pipeline.submit(dict(item, site=site, retry=True),
+                group=site["prefix"])
+            continue
+        try:
+            if item["by_id"]:
+                post_page, url = fetch_question(site, item["id"], c)
+            else:
+                post_page, url = curl(site, item["sub_url"], c), item["url"]
+            if post_page is not None:
+                post_txt, taglist = parse_post_page(post_page)
+                process_post(site, item["id"], post_txt, taglist, url)
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            return "abort"
+        except Exception as err:
+            retry_later(site, item, err)
+            continue
+
+        site["retry"].done(key)
+        # count on success
+        succ_posts += 1
+    if pipeline is not None:
+        try:
+            succ_posts += pipeline.join(group=site["prefix"])
+        except (KeyboardInterrupt, SystemExit):
+            print("[abort]")
+            pipeline.abort()
+            return "abort"
+    # log retried posts
+    with open(f"{site['prefix']}.log", "a") as page_log:
+        page_log.write(f"retry: {succ_posts} of {len(due)} posts successful.\n")
+    return "finish"
+
+
+def drain_retries(site, extra_opt):
+    # retry all pending posts now, then those failing again when due
+    until = float("inf")
+    while True:
+        r = retry_posts(site, extra_opt, until)
+        if r == "abort":
+            return r
+        next_due = site["retry"].next_due()
+        if next_due is None:
+            return "finish"
+        wait = next_due - time.time()
+        if wait > 0:
+            print(f"[{site['prefix']}] next retry in {wait:.0f} sec")
+            time.sleep(wait)
+        until = None
+
+
+def split_range(begin: int, end: int, crawler: int, total_crawlers: int):
+    # contiguous, non-overlapping share of [begin, end] for one crawler
+    per_crawler = math.ceil((end - begin + 1) / total_crawlers)
+    share_begin = begin + (crawler - 1) * per_crawler
+    return share_begin, min(end, share_begin + per_crawler - 1)
+
+
+def crawl_site(site, begin_page: int, end_page: int, extra_opt):
+    id_range = extra_opt["id-range"]
+    if id_range is not None:
+        load_gap_map(site)
+        if extra_opt["crawler"] is not None:
+            id_range = split_range(*id_range, *extra_opt["crawler"])
+    elif extra_opt["crawler"] is not None:
+        # divide pages of this site among crawlers
+        crawler, total_crawlers = extra_opt["crawler"]
+        total_pages = crawl_total_pages(site)
+        if total_pages == 0:
+            print(f"[{site['prefix']}] cannot get total pages, skip site",
+                file=sys.stderr)
+            return "abort"
+        begin_page, end_page = split_range(
+            1, total_pages, crawler, total_crawlers
+        )
+        if end_page < begin_page:
+            # more crawlers than pages, nothing left for this one
+            return "finish"
+
+    while True:
+        if id_range is not None:
+            # crawling questions by ID, no listing pages involved
+            r = crawl_id_range(site, *id_range, extra_opt)
+        else:
+            # crawling newest pages
+            r = crawl_pages(site, "newest", begin_page, end_page, extra_opt)
+        if r == "abort":
+            break
+
+        # if patrol mode is enabled, also crawl recently active
+        # posts.
+        if extra_opt["patrol"] and id_range is None:
+            # crawling recently active pages
+            r = crawl_pages(site, "active", begin_page, end_page, extra_opt)
+            if r == "abort":
+                break
+
+        # spend the revisit budget on posts most likely changed by now
+        if site["revisit"] is not None:
+            r = revisit_posts(site, extra_opt)
+            if r == "abort":
+                break
+
+        r = retry_posts(site, extra_opt)
+        if r == "abort":
+            break
+
+        # make this pass visible downstream before the hook script.
+        flush_sinks(site["sinks"])
+
+        # now it is the time to invoke hookscript,
+        # with the change journal of this pass as argument.
+        journal_path = site["journal"].rotate()
+        if extra_opt["hookscript"]:
+            hookscript = extra_opt["hookscript"]
+            os.system(f"{hookscript} {shlex.quote(journal_path)}")
+
+        if extra_opt["patrol"]:
+            # if patrol mode is enabled, loop forever.
+            pass
+        else:
+            break
+    return r
+
+
+def crawl_sites(sites, begin_page: int, end_page: int, extra_opt):
+    if extra_opt["retry-failed"]:
+        # only drain the retry queue of each site
+        crawl, args = drain_retries, (extra_opt,)
+    else:
+        crawl, args = crawl_site, (begin_page, end_page, extra_opt)
+    if len(sites) == 1:
+        return crawl(sites[0], *args)
+
+    # one thread per site, they only wait on their own host's rate budget
+    threads = [
+        threading.Thread(target=crawl, args=(site, *args), daemon=True)
+        for site in sites
+    ]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(timeout=1.0)
+    except (KeyboardInterrupt, SystemExit):
+        print("[abort]")
+        if extra_opt["pipeline"] is not None:
+            extra_opt["pipeline"].abort()
+        return "abort"
     return "finish"
 
 
@@ -323,16 +840,50 @@ def help(arg0: str):
         "\n\n"
         "SYNOPSIS:\n"
         f"{arg0} "
-        f"[--site {' | '.join([k for k in SE_SITE_ROOT.keys()])} ] "
+        f"[--site {' | '.join([k for k in SE_SITE_ROOT.keys()])} | all ] "
         "[-b | --begin-page <page>] "
         "[-e | --end-page <page>] "
         "[-c | --crawler <crawler-number>/<total-crawlers>] "
+        "[--id-range <begin id>-<end id>] "
         "[--total-pages] "
         "[--no-overwrite] "
+        "[--seen-filter <filter file>] "
         "[--patrol] "
+        "[--revisit-budget <requests per hour>] "
         "[--save-preview] "
         "[--hook-script <script name>] "
+        "[--journal-keep <journals>] "
+        f"[--sink {' | '.join(SINK_NAMES)} ] "
+        "[--sink-config <feeder config>] "
+        "[--sink-corpus <config section>] "
+        f"[--dedup {' | '.join(DEDUP_MODES)} ] "
+        "[--dedup-threshold <similarity>] "
+        "[--dedup-index <sqlite file>] "
+        "[--metrics-port <port>] "
+        "[--metrics-json <file>] "
+        "[--profile <directory>] "
+        "[--root-url <url>] "
+        "[--delay <seconds>] "
+        "[-j | --jobs <extraction processes>] "
+        "[--fetchers <download threads>] "
+        "[--egress direct | <proxy URL> | addr:<local address>] "
+        "[--egress-cooldown <seconds>] "
+        "[--retry-failed] "
         "[-p | --post <post id>] "
+        "\n\n"
+        "--site can be given more than once, to crawl multiple sites "
+        "concurrently in one process. So can --egress, to spread requests "
+        "over several routes, each with the --delay budget."
+        "\n"
+        "--revisit-budget makes --patrol revisit known posts by their "
+        "change rate instead of listing order, within a total budget of "
+        "requests per hour (listing pages included), shared among sites."
+        "\n"
+        "--seen-filter skips posts in a filter made by seen_filter.py, "
+        "e.g., crawled by other nodes, along with --no-overwrite."
+        "\n"
+        "Failed posts are retried later with backoff, --retry-failed only "
+        "retries them, until none is left."
         "\n"
     )
     sys.exit(1)
@@ -343,34 +894,77 @@ def main(args: List[str]):
     try:
         opts, _ = getopt.getopt(
             argv,
-            "s:b:e:p:c:h",
+            "s:b:e:p:c:j:h",
             [
                 "site=",
                 "begin-page=",
                 "end-page=",
+                "id-range=",
                 "crawler=",
                 "total-pages",
                 "post=",
                 "no-overwrite",
+                "seen-filter=",
                 "patrol",
+                "revisit-budget=",
                 "save-preview",
                 "hook-script=",
+                "journal-keep=",
+                "sink=",
+                "sink-config=",
+                "sink-corpus=",
+                "dedup=",
+                "dedup-threshold=",
+                "dedup-index=",
+                "metrics-port=",
+                "metrics-json=",
+                "profile=",
+                "root-url=",
+                "delay=",
+                "jobs=",
+                "fetchers=",
+                "egress=",
+                "egress-cooldown=",
+                "retry-failed",
             ],
         )
     except:
         help(args[0])
 
     # default arguments
-    global file_prefix
-    global root_url
+    global egress
     extra_opt = {
         "overwrite": True,
+        "seen": None,
         "hookscript": "",
+        "journal-keep": 100,
         "patrol": False,
+        "revisit-budget": 0,
         "save-preview": False,
+        "sinks": [],
+        "sink-config": os.path.join(
+            os.path.dirname(__file__), "feeder", "feeder.ini"
+        ),
+        "sink-corpus": "crawler",
+        "dedup": None,
+        "dedup-threshold": 0.95,
+        "dedup-index": "./near_dup.sqlite",
+        "delay": 1.5,
+        "jobs": 0,
+        "fetchers": 1,
+        "pipeline": None,
+        "crawler": None,
+        "id-range": None,
+        "egress": [],
+        "egress-cooldown": 60.0,
+        "retry-failed": False,
     }
     begin_page = 1
     end_page = -1
+    single_post = None
+    total_pages = False
+    site_names = []
+    root_url = None
 
     for opt, arg in opts:
         if opt in ("-b", "--begin-page"):
@@ -379,62 +973,143 @@ def main(args: List[str]):
         elif opt in ("-e", "--end-page"):
             end_page = int(arg)
             continue
+        elif opt == "--id-range":
+            begin_id, end_id = map(lambda x: int(x), arg.split('-'))
+            extra_opt["id-range"] = (begin_id, end_id)
+            continue
         elif opt in ("-c", "--crawler"):
+            # pages (or IDs) are divided per site, see crawl_site()
             crawler, total_crawlers = map(lambda x: int(x), arg.split('/'))
-            total_pages = crawl_total_pages()
-            pages_per_crawler = math.ceil(total_pages / total_crawlers)
-            begin_page = 1 + (crawler - 1) * pages_per_crawler
-            end_page = crawler * pages_per_crawler
+            extra_opt["crawler"] = (crawler, total_crawlers)
             continue
-        elif opt in ("--total-pages"):
-            total_pages = crawl_total_pages()
-            print('Total pages:', total_pages)
-            quit(0)
+        elif opt == "--total-pages":
+            total_pages = True
         elif opt in ("-p", "--post"):
-            sub_url = "/questions/" + arg
-            sub_url = sub_url + "?noredirect=1"
-            full_url = root_url + sub_url
-            post_txt, taglist = crawl_post_page(sub_url, get_curl())
-            process_post(int(arg), post_txt, taglist, full_url, True)
-            exit(0)
+            single_post = arg
         elif opt in ("--no-overwrite"):
             extra_opt["overwrite"] = False
+        elif opt == "--seen-filter":
+            # imported here, most runs do not share a seen filter
+            from seen_filter import SeenFilter
+            extra_opt["seen"] = SeenFilter(arg)
         elif opt in ("--patrol"):
             extra_opt["patrol"] = True
+        elif opt == "--revisit-budget":
+            extra_opt["revisit-budget"] = float(arg)
         elif opt in ("--save-preview"):
             extra_opt["save-preview"] = True
         elif opt in ("--hook-script"):
             extra_opt["hookscript"] = arg
+        elif opt == "--journal-keep":
+            extra_opt["journal-keep"] = int(arg)
         elif opt in ("--site"):
-            file_prefix = arg
-            root_url = SE_SITE_ROOT[arg]
+            if arg == "all":
+                site_names += SE_SITE_ROOT.keys()
+            elif arg in SE_SITE_ROOT:
+                site_names.append(arg)
+            else:
+                help(args[0])
+        elif opt == "--sink":
+            if arg not in SINK_NAMES:
+                help(args[0])
+            extra_opt["sinks"].append(arg)
+        elif opt == "--sink-config":
+            extra_opt["sink-config"] = arg
+        elif opt == "--sink-corpus":
+            extra_opt["sink-corpus"] = arg
+        elif opt == "--dedup":
+            if arg not in DEDUP_MODES:
+                help(args[0])
+            extra_opt["dedup"] = arg
+        elif opt == "--dedup-threshold":
+            extra_opt["dedup-threshold"] = float(arg)
+        elif opt == "--dedup-index":
+            extra_opt["dedup-index"] = arg
+        elif opt == "--metrics-port":
+            serve_metrics(int(arg))
+        elif opt == "--metrics-json":
+            dump_json_periodically(arg)
+        elif opt == "--profile":
+            enable_profile(arg)
+        elif opt == "--root-url":
+            # e.g., a local replay server, see bench/
+            root_url = arg
+        elif opt == "--delay":
+            extra_opt["delay"] = float(arg)
+        elif opt in ("-j", "--jobs"):
+            extra_opt["jobs"] = int(arg)
+        elif opt == "--fetchers":
+            extra_opt["fetchers"] = int(arg)
+        elif opt == "--egress":
+            extra_opt["egress"].append(arg)
+        elif opt == "--egress-cooldown":
+            extra_opt["egress-cooldown"] = float(arg)
+        elif opt == "--retry-failed":
+            extra_opt["retry-failed"] = True
         else:
             help(args[0])
 
-    if end_page >= begin_page:
-        while True:
-            # crawling newest pages
-            r = crawl_pages("newest", begin_page, end_page, extra_opt)
-            if r == "abort":
-                break
+    if len(extra_opt["egress"]) > 0:
+        # every route gets the --delay budget per host
+        delay = extra_opt["delay"]
+        egress = EgressPool(
+            extra_opt["egress"], 1.0 / delay if delay > 0 else 0,
+            cooldown=extra_opt["egress-cooldown"]
+        )
 
-            # if patrol mode is enabled, also crawl recently active
-            # posts.
-            if extra_opt["patrol"]:
-                # crawling recently active pages
-                r = crawl_pages("active", begin_page, end_page, extra_opt)
-                if r == "abort":
-                    break
-
-            # now it is the time to invoke hookscript.
-            if extra_opt["hookscript"]:
-                os.system(extra_opt["hookscript"])
-
-            if extra_opt["patrol"]:
-                # if patrol mode is enabled, loop forever.
-                pass
-            else:
-                break
+    # e.g., a local replay server for every site, see bench/
+    sites = [
+        make_site(name, root_url or SE_SITE_ROOT[name], extra_opt)
+        for name in dict.fromkeys(site_names or [DEFAULT_SITE])
+    ]
+
+    if total_pages:
+        for site in sites:
+            print(f'[{site["prefix"]}] Total pages:', crawl_total_pages(site))
+        quit(0)
+
+    if single_post is not None:
+        site = sites[0]
+        open_site(site, extra_opt, True)
+        sub_url = "/questions/" + single_post
+        sub_url = sub_url + "?noredirect=1"
+        full_url = site["root_url"] + sub_url
+        # no retry queue for a single post, try again right away (an
+        # error page fails parsing, so retry both)
+        post_txt, taglist = retry_soon(
+            crawl_post_page, site, sub_url, get_curl()
+        )
+        process_post(site, int(single_post), post_txt, taglist, full_url)
+        close_site(site)
+        exit(0)
+
+    if (end_page >= begin_page or extra_opt["crawler"] is not None
+        or extra_opt["id-range"] is not None or extra_opt["retry-failed"]):
+        if extra_opt["jobs"] > 0:
+            # download, extract and write posts in a staged pipeline
+            from crawl_pipeline import Pipeline
+            extra_opt["pipeline"] = Pipeline(
+                fetch_post, extract_post, write_post, fail_post,
+                done=done_post,
+                jobs=extra_opt["jobs"], fetchers=extra_opt["fetchers"]
+            )
+        for site in sites:
+            open_site(site, extra_opt, extra_opt["save-preview"])
+            if extra_opt["patrol"] and extra_opt["revisit-budget"] > 0:
+                # only imported with --revisit-budget
+                from revisit_scheduler import RevisitScheduler
+                site["revisit"] = RevisitScheduler(
+                    revisit_path(site),
+                    extra_opt["revisit-budget"] / len(sites)
+                )
+        crawl_sites(sites, begin_page, end_page, extra_opt)
+        if extra_opt["pipeline"] is not None:
+            extra_opt["pipeline"].close()
+        for site in sites:
+            close_site(site)
+        if egress is not None:
+            for route in egress.summary():
+                print("[egress]", route)
     else:
         help(args[0])
 
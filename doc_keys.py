@@ -0,0 +1,28 @@
+import re
+from urllib.parse import urlsplit
+
+
+def doc_id_key(doc_id: str):
+    """
+    (file prefix, key, division number) of a document ID, e.g.,
+    "mse1886701" or "aops-c6h1234p5678", None if it is neither.
+    """
+    res = re.fullmatch(r"([a-z]+)-(c\d+h(\d+)p\d+)", doc_id)
+    if res is not None:
+        return res.group(1), res.group(2), int(res.group(3))
+    res = re.fullmatch(r"([a-z]+)(\d+)", doc_id)
+    if res is not None:
+        return res.group(1), f"questions/{res.group(2)}", int(res.group(2))
+    return None
+
+
+def url_key(url: str):
+    # (key, division number) of a post or topic URL, same keys as above
+    path = urlsplit(url).path
+    res = re.search(r"/community/(c\d+h(\d+)p\d+)", path)
+    if res is not None:
+        return res.group(1), int(res.group(2))
+    res = re.search(r"/questions/(\d+)", path)
+    if res is not None:
+        return f"questions/{res.group(1)}", int(res.group(1))
+    return None
@@ -0,0 +1,110 @@
+import time
+import threading
+from urllib.parse import urlsplit
+from rate_limit import TokenBucket
+from stage_metrics import incr
+
+ADDRESS_PREFIX = "addr:"
+
+
+class EgressRoute:
+    """
+    One way out: "direct", an HTTP/SOCKS proxy URL (e.g.,
+    socks5h://10.0.0.7:1080), or "addr:<local address or interface>"
+    to send requests from another source address of this node.
+    """
+
+    def __init__(self, spec: str, rate: float, burst: float):
+        self.spec = spec
+        self.rate = rate
+        self.burst = burst
+        # hosts limit requests per client address, so budgets are per host
+        self.buckets = {}
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.throttles = 0
+        self.counts = {"requests": 0, "failures": 0, "throttled": 0}
+
+    def bucket(self, host: str) -> TokenBucket:
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    def configure(self, c):
+        # c must be freshly set up, a source address can not be unset
+        if self.spec.startswith(ADDRESS_PREFIX):
+            c.setopt(c.INTERFACE, self.spec[len(ADDRESS_PREFIX):])
+        elif self.spec != "direct":
+            c.setopt(c.PROXY, self.spec)
+
+
+class EgressPool:
+    """
+    Spread requests over egress routes, each with its own rate budget
+    per host. Routes that fail repeatedly, or that the host throttles,
+    are taken out of rotation for a cool-down period (doubled on every
+    successive throttle) while the other routes carry on.
+    """
+
+    def __init__(self, specs, rate: float, burst=1.0,
+            cooldown=60.0, max_cooldown=1800.0, max_failures=3):
+        self.routes = [EgressRoute(spec, rate, burst) for spec in specs]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+
+    def acquire(self, url: str) -> EgressRoute:
+        # take the healthy route that can send to this host the soonest
+        host = urlsplit(url).netloc
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                ready = [r for r in self.routes if r.cooldown_until <= now]
+                if len(ready) > 0:
+                    route = min(
+                        ready, key=lambda r: r.bucket(host).available_in()
+                    )
+                    wait = route.bucket(host).reserve()
+                    route.counts["requests"] += 1
+                    break
+                wait = min(r.cooldown_until for r in self.routes) - now
+            print(f"[egress] all routes cooling down, wait {wait:.1f} sec")
+            time.sleep(wait)
+        if wait > 0:
+            time.sleep(wait)
+        return route
+
+    def succeeded(self, route: EgressRoute):
+        with self.lock:
+            route.failures = 0
+            route.throttles = 0
+
+    def failed(self, route: EgressRoute):
+        with self.lock:
+            route.failures += 1
+            route.counts["failures"] += 1
+            if route.failures >= self.max_failures:
+                route.failures = 0
+                self.cool_down(route, self.cooldown, "failing")
+
+    def throttled(self, route: EgressRoute):
+        incr("egress_throttled")
+        with self.lock:
+            route.throttles += 1
+            route.counts["throttled"] += 1
+            seconds = self.cooldown * 2 ** (route.throttles - 1)
+            self.cool_down(route, min(seconds, self.max_cooldown), "throttled")
+
+    def cool_down(self, route: EgressRoute, seconds: float, reason: str):
+        route.cooldown_until = time.monotonic() + seconds
+        print(f"[egress] {route.spec} {reason}, out for {seconds:.0f} sec")
+
+    def summary(self):
+        with self.lock:
+            now = time.monotonic()
+            return [
+                dict(route.counts, route=route.spec,
+                    cooling=max(0.0, route.cooldown_until - now))
+                for route in self.routes
+            ]
@@ -1,51 +1,214 @@
 import os
 import sys
+import time
 import json
+import heapq
+import queue
+import random
+import itertools
+import collections
+import bisect
+import hashlib
 import requests
+import threading
 import argparse
 import configparser
 from tqdm import tqdm
+from stage_metrics import instrument, incr
+from stage_metrics import serve_metrics, dump_json_periodically, enable_profile
 from urllib.parse import urlparse
 from collections.abc import Iterable
 
 
+COMPRESS_EXTENSIONS = ['gz', 'zst']
+
+
+def file_extension(filename):
+    # keep the inner extension of compressed files, e.g., "jsonl.gz"
+    fields = filename.split('.')
+    if len(fields) > 2 and fields[-1] in COMPRESS_EXTENSIONS:
+        return '.'.join(fields[-2:])
+    elif fields[-1] == 'tgz':
+        return 'tar.gz'
+    return fields[-1]
+
+
 def file_walk(directory_or_filepath):
     path = os.path.expanduser(directory_or_filepath)
     if os.path.isfile(path):
-        ext = path.split('.')[-1]
+        ext = file_extension(path)
         yield path, ext
     for dirname, dirs, files in os.walk(path):
         for f in files:
-            ext = f.split('.')[-1]
+            ext = file_extension(f)
             yield os.path.join(dirname, f), ext
 
 
+def open_text(path, ext):
+    if ext.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt')
+    elif ext.endswith('.zst'):
+        import io
+        import zstandard # optional, only needed for .zst input
+        fh = open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(fh, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    else:
+        return open(path, 'r')
+
+
+def read_jsonl_lines(fh, src_prefix):
+    for ln, line in enumerate(fh):
+        yield f'{src_prefix}:{ln}', line
+
+
+def read_tar_members(path):
+    import codecs
+    import tarfile
+    # streaming mode ('r|*'), members are decompressed in order
+    # and never extracted to disk.
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            ext = file_extension(member.name)
+            if ext not in ['json', 'jsonl']:
+                continue
+            fh = codecs.getreader('utf-8')(tar.extractfile(member))
+            src_prefix = f'{path}/{member.name}'
+            if ext == 'jsonl':
+                yield from read_jsonl_lines(fh, src_prefix)
+            else:
+                yield src_prefix, fh.read()
+
+
+def read_compressed(path, ext):
+    if ext.startswith('tar'):
+        yield from read_tar_members(path)
+    else:
+        with open_text(path, ext) as fh:
+            yield from read_jsonl_lines(fh, path)
+
+
+def threaded_reader(generator, batch_size=512, max_batches=16):
+    # run decompression in a separate thread, handing over batches of
+    # lines through a bounded queue to overlap it with feeding.
+    q = queue.Queue(maxsize=max_batches)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            batch = []
+            for item in generator:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            put(batch)
+        except Exception as err:
+            put(err)
+        put(None)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = q.get()
+            if batch is None:
+                break
+            elif isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
+
+
 def json_walk(directory, allow_extensions, max_items):
     cnt = 0
     for path, ext in file_walk(directory):
         if ext not in allow_extensions:
             continue
-        with open(path, 'r') as fh:
-            if ext == 'jsonl':
-                for ln, line in enumerate(fh):
+        if ext == 'jsonl':
+            with open(path, 'r') as fh:
+                for src_id, line in read_jsonl_lines(fh, path):
                     cnt += 1
                     if cnt > max_items:
                         return
                     else:
-                        yield f'{path}:{ln}', line
-            elif ext == 'json':
+                        yield src_id, line
+        elif ext == 'json':
+            with open(path, 'r') as fh:
                 cnt += 1
                 if cnt > max_items:
                     return
                 else:
                     yield f'{path}', fh.read()
-            else:
-                raise NotImplemented
+        elif ext in ['jsonl.gz', 'jsonl.zst', 'tar', 'tar.gz']:
+            for src_id, j_str in threaded_reader(read_compressed(path, ext)):
+                cnt += 1
+                if cnt > max_items:
+                    return
+                else:
+                    yield src_id, j_str
+        else:
+            raise NotImplementedError(f'unsupported extension: {ext}')
+
+
+def journal_walk(journal_path, max_items):
+    # only created or updated documents of a crawler change journal,
+    # see change_journal.py, the latest entry of a path wins. Documents
+    # in JSONL segments are journaled as '<segment path>:<line number>'.
+    paths = {}
+    with open(journal_path, 'r') as fh:
+        for line in fh:
+            entry = json.loads(line)
+            if entry['action'] in ['created', 'updated']:
+                paths[entry['path']] = True
+    cnt = 0
+    segments = {}
+    for path in paths:
+        segment, _, ln = path.rpartition(':')
+        if segment.endswith('.jsonl') and ln.isdigit():
+            segments.setdefault(segment, set()).add(f'{segment}:{ln}')
+            continue
+        if not os.path.isfile(path):
+            continue
+        cnt += 1
+        if cnt > max_items:
+            return
+        with open(path, 'r') as fh:
+            yield path, fh.read()
+    # read each segment once, for all of its lines in the journal
+    for segment, src_ids in segments.items():
+        if not os.path.isfile(segment):
+            continue
+        with open(segment, 'r') as fh:
+            for src_id, line in read_jsonl_lines(fh, segment):
+                if src_id not in src_ids:
+                    continue
+                cnt += 1
+                if cnt > max_items:
+                    return
+                yield src_id, line
 
 
+@instrument('send_json')
 def send_json(url, send_j):
     headers = {'content-type': 'application/json'}
     r = requests.post(url, json=send_j, headers=headers)
+    r.raise_for_status()
     return json.loads(r.content.decode("utf-8"))
 
 
@@ -60,40 +223,388 @@ def send_to_each_indexd(indexd_urls, send_j, abort_value=1):
     return res
 
 
+def consistent_hash(key):
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def build_hash_ring(indexd_urls, vnodes=128):
+    # each indexd owns `vnodes' points on the ring, so that adding or
+    # removing one instance only moves about 1/N of the documents.
+    points = sorted(
+        (consistent_hash(f'{url}#{v}'), url)
+        for url in indexd_urls for v in range(vnodes)
+    )
+    return [h for h, _ in points], [url for _, url in points]
+
+
+def route_to_shards(ring, key, replicas):
+    hashes, urls = ring
+    replicas = min(replicas, len(set(urls)))
+    i = bisect.bisect(hashes, consistent_hash(key))
+    shards = []
+    while len(shards) < replicas:
+        url = urls[i % len(urls)]
+        if url not in shards:
+            shards.append(url)
+        i += 1
+    return shards
+
+
+def retry_policy(config):
+    return {
+        'max_attempts': config.getint('retry_max_attempts', 6),
+        'base_delay': config.getfloat('retry_base_delay', 1.0),
+        'max_delay': config.getfloat('retry_max_delay', 60.0),
+        'retry_buffer': config.getint('retry_buffer', 10000),
+        'breaker_threshold': config.getint('breaker_threshold', 5),
+        'breaker_cooldown': config.getfloat('breaker_cooldown', 30.0)
+    }
+
+
+def retry_delay(policy, attempts):
+    delay = min(policy['base_delay'] * 2 ** (attempts - 1), policy['max_delay'])
+    # jitter, so that retries of a burst do not hit indexd all at once
+    return delay * random.uniform(0.5, 1.0)
+
+
+def open_dead_letter(path):
+    return {'path': path, 'fh': None, 'lock': threading.Lock(), 'count': 0}
+
+
+def write_dead_letter(dead_letter, entry):
+    with dead_letter['lock']:
+        if dead_letter['fh'] is None:
+            dead_letter['fh'] = open(dead_letter['path'], 'a')
+        dead_letter['fh'].write(json.dumps(entry, sort_keys=True) + '\n')
+        dead_letter['fh'].flush()
+        dead_letter['count'] += 1
+
+
+def close_dead_letter(dead_letter):
+    if dead_letter['fh'] is not None:
+        dead_letter['fh'].close()
+        dead_letter['fh'] = None
+
+
+def read_dead_letter(path):
+    with open(path, 'r') as fh:
+        for line in fh:
+            yield json.loads(line)
+
+
+def open_spill(path):
+    # documents a shard queue has no room for, appended to a JSONL file
+    # and read back in order by the shard worker, so a slow indexd does
+    # not hold up feeding the others.
+    return {'path': path, 'fh': None, 'lock': threading.Lock(),
+        'offset': 0, 'written': 0, 'read': 0}
+
+
+def enqueue(shard, item):
+    spill = shard['spill']
+    with spill['lock']:
+        if spill['written'] == spill['read']:
+            try:
+                shard['queue'].put_nowait(item)
+                return
+            except queue.Full:
+                pass
+        # keep the order: once spilling, everything goes to the spill
+        # file until the shard worker has read it all.
+        if spill['fh'] is None:
+            spill['fh'] = open(spill['path'], 'wb+')
+        spill['fh'].seek(0, os.SEEK_END)
+        spill['fh'].write((json.dumps(item) + '\n').encode('utf-8'))
+        spill['fh'].flush()
+        spill['written'] += 1
+        incr('docs_spilled')
+
+
+def read_spill(spill, max_items):
+    items = []
+    with spill['lock']:
+        if spill['fh'] is None:
+            return items
+        spill['fh'].seek(spill['offset'])
+        while len(items) < max_items and spill['read'] < spill['written']:
+            items.append(json.loads(spill['fh'].readline()))
+            spill['read'] += 1
+        spill['offset'] = spill['fh'].tell()
+        if spill['read'] == spill['written']:
+            # all read, start over with an empty file on the next spill
+            spill['fh'].close()
+            os.remove(spill['path'])
+            spill['fh'] = None
+            spill['offset'] = 0
+    return items
+
+
+def spilled(shard):
+    return shard['spill']['written'] - shard['spill']['read']
+
+
+def shard_worker(shard, policy, dead_letter):
+    retries = [] # min-heap of (due time, seq, item)
+    seq = itertools.count()
+    spilled_items = collections.deque()
+    closing = False
+
+    def give_up(item, err):
+        shard['dead'] += 1
+        incr('docs_dead_lettered')
+        write_dead_letter(dead_letter, {
+            'indexd_url': shard['url'],
+            'src_id': item['src_id'],
+            'doc': item['doc'],
+            'attempts': item['attempts'],
+            'error': str(err)
+        })
+
+    def postpone(item, due, err):
+        item['attempts'] += 1
+        if item['attempts'] >= policy['max_attempts']:
+            give_up(item, err)
+        elif len(retries) >= policy['retry_buffer']:
+            give_up(item, 'retry buffer is full')
+        else:
+            heapq.heappush(retries, (due, next(seq), item))
+
+    while not closing or retries:
+        now = time.time()
+        if now < shard['open_until']:
+            # circuit is open, leave documents in the queue (and spill
+            # file) until it half-opens.
+            time.sleep(min(shard['open_until'] - now, 1.0))
+            continue
+        elif retries and retries[0][0] <= now:
+            _, _, item = heapq.heappop(retries)
+        elif closing:
+            time.sleep(min(retries[0][0] - now, 1.0))
+            continue
+        else:
+            # spilled documents come after those in the queue
+            if not spilled_items and shard['queue'].empty():
+                spilled_items.extend(
+                    read_spill(shard['spill'], shard['queue'].maxsize)
+                )
+            if spilled_items:
+                item = spilled_items.popleft()
+            else:
+                timeout = retries[0][0] - now if retries else None
+                try:
+                    item = shard['queue'].get(timeout=timeout)
+                except queue.Empty:
+                    continue
+            if item is None:
+                closing = True
+                continue
+
+        try:
+            res = send_json(shard['url'], item['doc'])
+            # a response without docID failed like any other send
+            if not isinstance(res, dict) or 'docid' not in res:
+                raise ValueError(f'no docid in response: {res}')
+        except Exception as err:
+            shard['failures'] += 1
+            if shard['failures'] >= policy['breaker_threshold']:
+                shard['open_until'] = time.time() + policy['breaker_cooldown']
+            due = time.time() + retry_delay(policy, item['attempts'] + 1)
+            postpone(item, due, err)
+            incr('send_retries')
+            continue
+        shard['failures'] = 0
+        shard['last_docid'] = res['docid']
+        shard['sent'] += 1
+        incr('docs_sent')
+
+
+def start_shard(url, queue_size, policy, dead_letter, spill_path):
+    shard = {
+        'url': url,
+        'queue': queue.Queue(maxsize=queue_size),
+        'spill': open_spill(spill_path),
+        'last_docid': None,
+        'sent': 0,
+        'dead': 0,
+        'failures': 0,
+        'open_until': 0
+    }
+    shard['thread'] = threading.Thread(
+        target=shard_worker, args=(shard, policy, dead_letter), daemon=True
+    )
+    shard['thread'].start()
+    return shard
+
+
+def start_shards(indexd_urls, queue_size, policy, dead_letter, spill):
+    # one bounded queue and one sender thread per indexd, so a shard
+    # slowing down for a while only backs up its own queue, and then
+    # its own spill file on disk.
+    return {
+        url: start_shard(url, queue_size, policy, dead_letter,
+            f'{spill}-{i}.jsonl')
+        for i, url in enumerate(indexd_urls)
+    }
+
+
+def stop_shards(shards):
+    for shard in shards.values():
+        enqueue(shard, None)
+    for shard in shards.values():
+        shard['thread'].join()
+
+
+def shards_description(shards):
+    return ', '.join(
+        f"{s['sent']} sent" + (f"/{s['dead']} dead" if s['dead'] else '')
+        + (f"/{spilled(s)} spilled" if spilled(s) else '')
+        + (' (circuit open)' if s['open_until'] > time.time() else '')
+        for s in shards.values()
+    )
+
+
+def print_shards_summary(shards, dead_letter):
+    for url, shard in shards.items():
+        print(f'{url}: {shard["sent"]} docs, {shard["dead"]} dead, '
+            f'last docID {shard["last_docid"]}')
+    if dead_letter['count'] > 0:
+        print(f'{dead_letter["count"]} entries written to {dead_letter["path"]}')
+
+
+def map_document(config, src_id, j, index_field_map):
+    send_j = {}
+    for key, value in index_field_map.items():
+        send_j[key] = go_thro_pipelines(config, src_id, j, value)
+        if send_j[key] is not None:
+            send_j[key] = send_j[key].strip()
+    return send_j
+
+
+def start_feeding(indexd_urls, config):
+    shard_mode = config.get('shard_mode', 'replicate')
+    if shard_mode not in ['replicate', 'hash']:
+        raise ValueError(f'unknown shard_mode: {shard_mode}')
+    dead_letter = open_dead_letter(
+        config.get('dead_letter', 'feeder-dead-letter.jsonl')
+    )
+    return {
+        'config': config,
+        'indexd_urls': indexd_urls,
+        'index_field_map': json.loads(config['index_field_map']),
+        'shard_mode': shard_mode,
+        # by URL, which stays the same when a document is re-journaled
+        'shard_key': config.get(
+            'shard_key', "j['url'] if 'url' in j else src_id"
+        ),
+        'shard_replicas': config.getint('shard_replicas', 1),
+        'ring': build_hash_ring(indexd_urls),
+        'dead_letter': dead_letter,
+        'shards': start_shards(
+            indexd_urls, config.getint('shard_queue_size', 256),
+            retry_policy(config), dead_letter,
+            config.get('shard_spill', 'feeder-spill')
+        )
+    }
+
+
+def feed_document(feeding, src_id, j):
+    config = feeding['config']
+    send_j = map_document(config, src_id, j, feeding['index_field_map'])
+    if feeding['shard_mode'] == 'hash':
+        key = str(go_thro_pipelines(config, src_id, j, feeding['shard_key']))
+        urls = route_to_shards(feeding['ring'], key, feeding['shard_replicas'])
+    else:
+        urls = feeding['indexd_urls']
+    for url in urls:
+        item = {'src_id': src_id, 'doc': send_j, 'attempts': 0}
+        enqueue(feeding['shards'][url], item)
+
+
+def stop_feeding(feeding):
+    stop_shards(feeding['shards'])
+    close_dead_letter(feeding['dead_letter'])
+    print_shards_summary(feeding['shards'], feeding['dead_letter'])
+    return feeding['dead_letter']['count']
+
+
 def feed(indexd_urls, args, config):
     allow_extensions = json.loads(config['allow_extensions'])
     index_field_map = json.loads(config['index_field_map'])
     max_items = config.getint('max_items') or float('inf')
     progress_bar = config.getboolean('progress_bar')
+    feeding = start_feeding(indexd_urls, config)
+
+    def walk():
+        if args.journal:
+            return journal_walk(args.journal, max_items)
+        return json_walk(args.CORPUS_PATH, allow_extensions, max_items)
 
     if progress_bar:
         print('Counting total #documents ...')
-        cnt = len(list(_ for _ in
-            json_walk(args.CORPUS_PATH, allow_extensions, max_items))
-        )
+        cnt = len(list(_ for _ in walk()))
     else:
         cnt = None
 
-    walker = json_walk(args.CORPUS_PATH, allow_extensions, max_items)
+    walker = walk()
     progress = tqdm(walker, total=cnt)
     for src_id, j_str in progress:
         try:
             j = json.loads(j_str)
         except Exception as e:
             print(e, '\n', j_str)
+            write_dead_letter(feeding['dead_letter'], {
+                'src_id': src_id, 'raw': j_str, 'error': str(e)
+            })
             continue
-        send_j = {}
-        for key, value in index_field_map.items():
-            send_j[key] = go_thro_pipelines(config, src_id, j, value)
-            if send_j[key] is not None:
-                send_j[key] = send_j[key].strip()
         if args.preview:
+            send_j = map_document(config, src_id, j, index_field_map)
             print('src_id:', src_id)
             print('preview:', send_j, end='\n\n')
             #print(send_j['content'])
-        else:
-            res = send_to_each_indexd(indexd_urls, send_j)
-            progress.set_description(f"Indexed doc: {res['docid']}")
+            continue
+        feed_document(feeding, src_id, j)
+        progress.set_description(shards_description(feeding['shards']))
+
+    return stop_feeding(feeding)
+
+
+def replay_dead_letter(path, config):
+    shard_queue_size = config.getint('shard_queue_size', 256)
+    shard_spill = config.get('shard_spill', 'feeder-spill')
+    policy = retry_policy(config)
+    dead_letter = open_dead_letter(
+        config.get('dead_letter', 'feeder-dead-letter.jsonl')
+    )
+
+    # documents failing again are appended to the dead-letter file,
+    # move the replayed file away if it is the same one.
+    if os.path.abspath(path) == os.path.abspath(dead_letter['path']):
+        replaying = f'{path}.replaying'
+        os.rename(path, replaying)
+        path = replaying
+
+    shards = {}
+    for entry in tqdm(read_dead_letter(path)):
+        if 'doc' not in entry:
+            # not a sendable document (e.g., bad JSON), keep it recorded
+            write_dead_letter(dead_letter, entry)
+            continue
+        url = entry['indexd_url']
+        if url not in shards:
+            shards[url] = start_shard(
+                url, shard_queue_size, policy, dead_letter,
+                f'{shard_spill}-{len(shards)}.jsonl'
+            )
+        item = {'src_id': entry['src_id'], 'doc': entry['doc'], 'attempts': 0}
+        enqueue(shards[url], item)
+
+    stop_shards(shards)
+    close_dead_letter(dead_letter)
+    print_shards_summary(shards, dead_letter)
+    if path.endswith('.replaying'):
+        os.remove(path)
+    return dead_letter['count']
 
 
 def go_thro_pipelines(config, src_id, j, value):
@@ -143,8 +654,13 @@ if __name__ == '__main__':
     parser.add_argument(
         'CONFIG', help='feeder config file', type=str
     )
+    # no corpus path is needed to feed a journal or a dead-letter file,
+    # otherwise keep it a plain positional, which may follow optionals.
+    no_corpus = any(arg.split('=')[0] in ['--journal', '--replay-dead-letter']
+        for arg in sys.argv[1:])
     parser.add_argument(
-        'CORPUS_PATH', help='corpus path', type=str
+        'CORPUS_PATH', help='corpus path (not needed with --journal or '
+        '--replay-dead-letter)', type=str, nargs='?' if no_corpus else None
     )
 
     # optionals
@@ -155,6 +671,34 @@ if __name__ == '__main__':
     parser.add_argument(
         '--corpus', help='corpus name', type=str, default='DEFAULT'
     )
+    parser.add_argument(
+        '--shard-mode', help='replicate (default) or hash-partition documents',
+        type=str, choices=['replicate', 'hash']
+    )
+    parser.add_argument(
+        '--shard-replicas', help='number of indexd copies per document',
+        type=int
+    )
+    parser.add_argument(
+        '--journal', help='feed documents listed in a crawler change journal',
+        type=str
+    )
+    parser.add_argument(
+        '--replay-dead-letter', help='re-send documents of a dead-letter file',
+        type=str
+    )
+    parser.add_argument(
+        '--metrics-port', help='serve Prometheus-style metrics on this port',
+        type=int
+    )
+    parser.add_argument(
+        '--metrics-json', help='dump metrics to this JSON file periodically',
+        type=str
+    )
+    parser.add_argument(
+        '--profile', help='dump per-stage cProfile data into this directory',
+        type=str
+    )
     parser.add_argument(
         '--bye', help='ask indexd to terminate at the end',
         action='store_true'
@@ -165,6 +709,13 @@ if __name__ == '__main__':
     )
     args = parser.parse_args()
 
+    if args.metrics_port is not None:
+        serve_metrics(args.metrics_port)
+    if args.metrics_json is not None:
+        dump_json_periodically(args.metrics_json)
+    if args.profile is not None:
+        enable_profile(args.profile)
+
     # parse config file
     config = configparser.ConfigParser()
     config.read(args.CONFIG)
@@ -172,6 +723,10 @@ if __name__ == '__main__':
     # overwrite indexd_url (args have higher priority) in config
     if args.indexd_url is not None:
         config.set('DEFAULT', 'indexd_url', json.dumps(args.indexd_url))
+    if args.shard_mode is not None:
+        config.set('DEFAULT', 'shard_mode', args.shard_mode)
+    if args.shard_replicas is not None:
+        config.set('DEFAULT', 'shard_replicas', str(args.shard_replicas))
 
     # print out parameters
     print('---' * 5, 'ARGS', '---' * 5)
@@ -184,9 +739,15 @@ if __name__ == '__main__':
     # feed data
     section_config = config[args.corpus]
     indexd_urls = json.loads(section_config['indexd_url'])
-    feed(indexd_urls, args, section_config)
+    if args.replay_dead_letter:
+        n_dead = replay_dead_letter(args.replay_dead_letter, section_config)
+    else:
+        n_dead = feed(indexd_urls, args, section_config)
 
     # send BYE command on request
     if args.bye and not args.preview:
         print('\n Now, send BYE to terminate indexers ... \n')
         send_to_each_indexd(indexd_urls, {'cmd': 'BYE'}, abort_value=0)
+
+    if n_dead > 0:
+        quit(1)
@@ -0,0 +1 @@
+../stage_metrics.py
\ No newline at end of file
@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import argparse
+import multiprocessing
+from near_dup import to_signed
+
+# math spans, after replace_post_tex.py
+IMATH = re.compile(r"\[imath\](.*?)\[/imath\]", re.DOTALL)
+
+# control words, control symbols, then any other single character
+TEX_TOKEN = re.compile(r"\\[a-zA-Z]+|\\.|\S", re.DOTALL)
+
+# JSON files handed to a worker at a time, segments go one per worker
+FILES_PER_TASK = 256
+
+
+def normalize_tex(tex: str) -> str:
+    """
+    Drop whitespace that does not change the meaning of a formula, so
+    "\\frac {a} {b}" and "\\frac{a}{b}" are one formula. Only a space
+    ending a control word before a letter is kept ("\\alpha b").
+    """
+    tokens = TEX_TOKEN.findall(tex)
+    out = []
+    for i, token in enumerate(tokens):
+        if (i > 0 and token[0].isalpha() and tokens[i - 1][0] == "\\"
+                and tokens[i - 1][-1].isalpha()):
+            out.append(" ")
+        out.append(token)
+    return "".join(out)
+
+
+def formula_hash(tex: str) -> int:
+    digest = hashlib.blake2b(tex.encode("utf-8"), digest_size=8).digest()
+    return to_signed(int.from_bytes(digest, "big"))
+
+
+def extract_formulas(text: str):
+    # {hash: [normalized TeX, occurrences]} of a document
+    formulas = {}
+    for span in IMATH.findall(text):
+        tex = normalize_tex(span)
+        if len(tex) == 0:
+            continue
+        h = formula_hash(tex)
+        if h not in formulas:
+            formulas[h] = [tex, 0]
+        formulas[h][1] += 1
+    return formulas
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def extract_document(src_id: str, doc):
+    return src_id, text_hash(doc["text"]), extract_formulas(doc["text"])
+
+
+def extract_task(task):
+    """
+    Run by worker processes: [(src_id, text hash, {hash: [tex,
+    occurrences]})] of a list of JSON files, or of a JSONL segment, and
+    [(src_id, error)] of the documents that can not be read. Source IDs
+    are the ones feeder.py uses, i.e., the (absolute) path, or
+    "<path>:<line number>".
+    """
+    kind, paths = task
+    results = []
+    failed = []
+    for path in paths:
+        try:
+            with open(path, "r") as fh:
+                if kind == "json":
+                    results.append(extract_document(path, json.load(fh)))
+                    continue
+                for ln, line in enumerate(fh):
+                    src_id = f"{path}:{ln}"
+                    try:
+                        doc = json.loads(line)
+                        results.append(extract_document(src_id, doc))
+                    except (ValueError, KeyError, TypeError) as err:
+                        failed.append((src_id, repr(err)))
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            failed.append((path, repr(err)))
+    return results, failed
+
+
+def source_exists(src_id: str) -> bool:
+    # a JSON file, or a line of a JSONL segment (by its file only)
+    segment, _, ln = src_id.rpartition(":")
+    if segment.endswith(".jsonl") and ln.isdigit():
+        return os.path.isfile(segment)
+    return os.path.isfile(src_id)
+
+
+def corpus_tasks(corpus_path: str):
+    # absolute paths, as in change journals, so that "./tmp" and "tmp"
+    # give the same source IDs
+    corpus_path = os.path.abspath(corpus_path)
+    batch = []
+    for dirname, dirs, files in os.walk(corpus_path):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(dirname, f)
+            if f.endswith(".jsonl"):
+                yield "jsonl", [path]
+            elif f.endswith(".json"):
+                batch.append(path)
+                if len(batch) >= FILES_PER_TASK:
+                    yield "json", batch
+                    batch = []
+    if len(batch) > 0:
+        yield "json", batch
+
+
+class FormulaTable:
+    """
+    On-disk table of unique (normalized) formulas: their frequency over
+    the corpus, the number of documents they appear in, and postings to
+    those documents. Documents already in the table are skipped unless
+    their text changed (e.g., overwritten by a patrol pass), then their
+    old postings are taken out first, and documents whose file is gone
+    are taken out altogether, so it can be extended after every
+    crawling pass.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS formulas (
+                hash INTEGER PRIMARY KEY, tex TEXT, length INTEGER,
+                freq INTEGER, docs INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                doc INTEGER PRIMARY KEY, src_id TEXT UNIQUE, text_hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                hash INTEGER, doc INTEGER, freq INTEGER,
+                PRIMARY KEY (hash, doc)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+        """)
+        columns = [
+            row[1] for row in self.db.execute("PRAGMA table_info(documents)")
+        ]
+        if "text_hash" not in columns:
+            # table of an earlier version, its documents get counted again
+            self.db.execute("ALTER TABLE documents ADD COLUMN text_hash TEXT")
+
+    def remove(self, doc: int):
+        # take the postings of a document out of the formula counts
+        postings = self.db.execute(
+            "SELECT hash, freq FROM postings WHERE doc = ?", (doc,)
+        ).fetchall()
+        self.db.executemany(
+            "UPDATE formulas SET freq = freq - ?, docs = docs - 1 "
+            "WHERE hash = ?", [(cnt, h) for h, cnt in postings]
+        )
+        self.db.executemany(
+            "DELETE FROM formulas WHERE hash = ? AND docs <= 0",
+            [(h,) for h, _ in postings]
+        )
+        self.db.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+
+    def prune(self) -> int:
+        # take out documents whose source no longer exists, return how many
+        removed = 0
+        rows = self.db.execute("SELECT doc, src_id FROM documents").fetchall()
+        for doc, src_id in rows:
+            if not os.path.isabs(src_id):
+                # source ID of an earlier version, the path as given
+                abs_id = os.path.abspath(src_id)
+                if self.db.execute(
+                    "SELECT 1 FROM documents WHERE src_id = ?", (abs_id,)
+                ).fetchone() is None:
+                    self.db.execute(
+                        "UPDATE documents SET src_id = ? WHERE doc = ?",
+                        (abs_id, doc)
+                    )
+                    src_id = abs_id
+                else:
+                    src_id = None
+            if src_id is None or not source_exists(src_id):
+                self.remove(doc)
+                self.db.execute("DELETE FROM documents WHERE doc = ?", (doc,))
+                removed += 1
+        self.db.commit()
+        return removed
+
+    def add(self, src_id: str, digest: str, formulas) -> str:
+        # "added", "updated" or "skipped" (unchanged) document
+        row = self.db.execute(
+            "SELECT doc, text_hash FROM documents WHERE src_id = ?", (src_id,)
+        ).fetchone()
+        if row is None:
+            doc = self.db.execute(
+                "INSERT INTO documents (src_id, text_hash) VALUES (?, ?)",
+                (src_id, digest)
+            ).lastrowid
+            action = "added"
+        elif row[1] == digest:
+            return "skipped"
+        else:
+            doc = row[0]
+            self.remove(doc)
+            self.db.execute(
+                "UPDATE documents SET text_hash = ? WHERE doc = ?",
+                (digest, doc)
+            )
+            action = "updated"
+        self.db.executemany("""
+            INSERT INTO formulas VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (hash) DO UPDATE SET
+                freq = freq + excluded.freq, docs = docs + 1
+        """, [(h, tex, len(tex), cnt) for h, (tex, cnt) in formulas.items()])
+        self.db.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?)",
+            [(h, doc, cnt) for h, (_, cnt) in formulas.items()]
+        )
+        return action
+
+    def build(self, corpus_path: str, jobs=None):
+        counts = {"added": 0, "updated": 0, "skipped": 0, "failed": 0}
+        removed = self.prune()
+        with multiprocessing.Pool(jobs or os.cpu_count()) as pool:
+            for results, failed in pool.imap_unordered(
+                extract_task, corpus_tasks(corpus_path)
+            ):
+                for src_id, digest, formulas in results:
+                    counts[self.add(src_id, digest, formulas)] += 1
+                for src_id, err in failed:
+                    print(f"[formula] skip {src_id}: {err}")
+                counts["failed"] += len(failed)
+                self.db.commit()
+        print(f"[formula] {counts['added']} documents added, "
+            f"{counts['updated']} changed, {counts['skipped']} unchanged, "
+            f"{removed} removed, {counts['failed']} failed")
+
+    def top(self, n: int):
+        return self.db.execute(
+            "SELECT tex, freq, docs FROM formulas ORDER BY freq DESC LIMIT ?",
+            (n,)
+        ).fetchall()
+
+    def stats(self):
+        docs = self.db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        unique, total = self.db.execute(
+            "SELECT COUNT(*), SUM(freq) FROM formulas"
+        ).fetchone()
+        return {
+            "documents": docs,
+            "formulas": total or 0,
+            "unique_formulas": unique,
+            "unique_ratio": round(unique / total, 4) if total else 0.0
+        }
+
+    def report(self):
+        print(f"[formula] {self.path}", self.stats())
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a table of unique formulas in crawled documents."
+    )
+    parser.add_argument("TABLE", help="sqlite table file", type=str)
+    parser.add_argument(
+        "CORPUS_PATH", help="crawled JSON files and JSONL segments to add, "
+        "or only report if absent", type=str, nargs="?"
+    )
+    parser.add_argument(
+        "-j", "--jobs", help="extraction processes (default: CPU count)",
+        type=int, default=None
+    )
+    parser.add_argument(
+        "--top", help="print the N most frequent formulas",
+        type=int, default=0
+    )
+    args = parser.parse_args()
+
+    table = FormulaTable(args.TABLE)
+    if args.CORPUS_PATH is not None:
+        table.build(args.CORPUS_PATH, args.jobs)
+    for tex, freq, docs in table.top(args.top):
+        print(f"{freq}\t{docs}\t{tex}")
+    table.report()
+    table.close()
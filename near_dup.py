@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import argparse
+import threading
+from collections import Counter
+
+FINGERPRINT_BITS = 64
+SHINGLE_SIZE = 3
+
+# shared indexes of this process, see open_index()
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def shingles(text: str):
+    # words and single symbols, so that TeX like [imath]x^2[/imath]
+    # still contributes its structure
+    tokens = re.findall(r"\w+|[^\w\s]", text.lower())
+    if len(tokens) < SHINGLE_SIZE:
+        return Counter([" ".join(tokens)])
+    return Counter(
+        " ".join(tokens[i:i + SHINGLE_SIZE])
+        for i in range(len(tokens) - SHINGLE_SIZE + 1)
+    )
+
+
+def simhash(text: str) -> int:
+    weights = [0] * FINGERPRINT_BITS
+    for shingle, cnt in shingles(text).items():
+        digest = hashlib.blake2b(shingle.encode("utf-8"), digest_size=8)
+        h = int.from_bytes(digest.digest(), "big")
+        for i in range(FINGERPRINT_BITS):
+            weights[i] += cnt if (h >> i) & 1 else -cnt
+    fingerprint = 0
+    for i, w in enumerate(weights):
+        if w > 0:
+            fingerprint |= 1 << i
+    return fingerprint
+
+
+def similarity(a: int, b: int) -> float:
+    return 1.0 - bin(a ^ b).count("1") / FINGERPRINT_BITS
+
+
+def max_distance(threshold: float) -> int:
+    return int((1.0 - threshold) * FINGERPRINT_BITS + 1e-9)
+
+
+def band_ranges(threshold: float):
+    """
+    Split fingerprints into (max distance + 1) bands, by pigeonhole any
+    fingerprint within the max distance agrees on at least one band.
+    Lower thresholds mean narrower bands and more candidates to check.
+    """
+    n = max_distance(threshold) + 1
+    bounds = [i * FINGERPRINT_BITS // n for i in range(n + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def to_signed(x: int) -> int:
+    # sqlite integers are signed 64-bit
+    return x - (1 << 64) if x >= (1 << 63) else x
+
+
+def to_unsigned(x: int) -> int:
+    return x + (1 << 64) if x < 0 else x
+
+
+class NearDupIndex:
+    """
+    On-disk SimHash LSH index. Fingerprints are kept in sqlite, bucketed
+    by band, so memory stays bounded however many documents are indexed.
+    Thread-safe, one instance can be shared by crawl threads.
+    """
+
+    def __init__(self, path: str, threshold=0.95, batch=1000):
+        self.path = path
+        self.threshold = threshold
+        self.bands = band_ranges(threshold)
+        self.batch = batch
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                doc_id TEXT PRIMARY KEY, simhash INTEGER, dup_of TEXT
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                band INTEGER, value INTEGER, doc_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS bands_value ON bands (band, value);
+            CREATE INDEX IF NOT EXISTS bands_doc ON bands (doc_id);
+        """)
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'bands'"
+        ).fetchone()
+        if row is None:
+            self.db.execute(
+                "INSERT INTO meta VALUES ('bands', ?)", (len(self.bands),)
+            )
+            self.db.commit()
+        elif int(row[0]) != len(self.bands):
+            raise Exception(
+                f"{path} is built for another threshold, "
+                "use the same threshold or a new index"
+            )
+
+    def band_values(self, fingerprint: int):
+        for band, (lo, hi) in enumerate(self.bands):
+            yield band, (fingerprint >> lo) & ((1 << (hi - lo)) - 1)
+
+    def lookup(self, doc_id: str, fingerprint: int):
+        # the most similar indexed document above threshold, if any
+        best, best_sim = None, 0.0
+        seen = set()
+        for band, value in self.band_values(fingerprint):
+            rows = self.db.execute(
+                "SELECT f.doc_id, f.simhash FROM bands b "
+                "JOIN fingerprints f ON f.doc_id = b.doc_id "
+                "WHERE b.band = ? AND b.value = ?", (band, value)
+            )
+            for other_id, other in rows:
+                if other_id == doc_id or other_id in seen:
+                    continue
+                seen.add(other_id)
+                sim = similarity(fingerprint, to_unsigned(other))
+                if sim >= self.threshold and sim > best_sim:
+                    best, best_sim = other_id, sim
+        return best, best_sim
+
+    def check(self, doc_id: str, text: str):
+        """
+        Return (ID of an earlier near-duplicate or None, similarity), and
+        add the document to the index. Near-duplicates are recorded but
+        not bucketed, later copies match the first document instead.
+        """
+        fingerprint = simhash(text)
+        with self.lock:
+            dup_of, sim = self.lookup(doc_id, fingerprint)
+            # a re-crawled document replaces its old fingerprint
+            self.db.execute("DELETE FROM bands WHERE doc_id = ?", (doc_id,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+                (doc_id, to_signed(fingerprint), dup_of)
+            )
+            if dup_of is None:
+                self.db.executemany(
+                    "INSERT INTO bands VALUES (?, ?, ?)",
+                    [(b, v, doc_id) for b, v in self.band_values(fingerprint)]
+                )
+            self.uncommitted += 1
+            if self.uncommitted >= self.batch:
+                self.commit()
+        return dup_of, sim
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def stats(self):
+        with self.lock:
+            docs, dups = self.db.execute(
+                "SELECT COUNT(*), COUNT(dup_of) FROM fingerprints"
+            ).fetchone()
+        return {
+            "documents": docs,
+            "near_duplicates": dups,
+            "dedup_ratio": round(dups / docs, 4) if docs else 0.0
+        }
+
+    def report(self):
+        print(f"[near-dup] {self.path}", self.stats())
+
+    def flush(self):
+        with self.lock:
+            self.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def open_index(path: str, threshold: float) -> NearDupIndex:
+    # one index per file in a process, e.g., shared by all crawled sites
+    with indexes_lock:
+        if path not in indexes:
+            indexes[path] = [NearDupIndex(path, threshold), 0]
+        indexes[path][1] += 1
+        return indexes[path][0]
+
+
+def close_index(index: NearDupIndex):
+    with indexes_lock:
+        indexes[index.path][1] -= 1
+        if indexes[index.path][1] == 0:
+            index.close()
+            del indexes[index.path]
+
+
+def corpus_walk(corpus_path: str):
+    for dirname, dirs, files in os.walk(corpus_path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.endswith(".json"):
+                path = os.path.join(dirname, f)
+                with open(path, "r") as fh:
+                    yield f[:-len(".json")], json.load(fh)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find near-duplicates among crawled JSON documents."
+    )
+    parser.add_argument("INDEX", help="sqlite index file", type=str)
+    parser.add_argument(
+        "CORPUS_PATH", help="crawled corpus to add, or only report if absent",
+        type=str, nargs="?"
+    )
+    parser.add_argument(
+        "--threshold", help="minimal similarity of near-duplicates "
+        "(default: 0.95)", type=float, default=0.95
+    )
+    parser.add_argument(
+        "--list", help="print near-duplicate pairs found",
+        action="store_true"
+    )
+    args = parser.parse_args()
+
+    index = NearDupIndex(args.INDEX, args.threshold)
+    if args.CORPUS_PATH is not None:
+        for doc_id, doc in corpus_walk(args.CORPUS_PATH):
+            dup_of, sim = index.check(doc_id, doc["text"])
+            if dup_of is not None and args.list:
+                print(f"{doc_id}\t{dup_of}\t{sim:.3f}")
+    index.report()
+    index.close()
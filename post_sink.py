@@ -0,0 +1,323 @@
+import os
+import sys
+import time
+import json
+import errno
+import threading
+import functools
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+SINK_NAMES = ["fs", "segment", "indexd"]
+
+DEDUP_MODES = ["flag", "drop"]
+
+
+def mkdir_p(path: str):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise Exception("mkdir needs permission")
+
+
+def dump_document(doc) -> str:
+    return json.dumps(doc, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=None)
+def preview_template() -> str:
+    with open(os.path.join(script_dir, "template.html"), "r") as f:
+        return f.read()
+
+
+def render_preview(txt: str, url: str) -> str:
+    # put preview into HTML template
+    txt = txt.replace("\n", "</br>")
+    return preview_template().replace("{PREVIEW}", txt).replace("{URL}", url)
+
+
+def save_preview(path: str, txt: str, url: str):
+    with open(path, "w", encoding="utf8") as f:
+        f.write(render_preview(txt, url))
+
+
+class FileSink:
+    """
+    One JSON file (and optionally one HTML preview) per document,
+    i.e., the ./tmp layout feeder.py walks.
+    """
+
+    def __init__(self, if_save_preview: bool = False):
+        self.if_save_preview = if_save_preview
+
+    def write(self, file_path: str, doc, src_id=None) -> str:
+        mkdir_p(os.path.dirname(file_path))
+        content = dump_document(doc)
+
+        # do not touch time stamp if previously
+        # an identical file already exists.
+        jsonfile = f"{file_path}.json"
+        action = "created"
+        if os.path.isfile(jsonfile):
+            print(f"[exists]{jsonfile}")
+            with open(jsonfile, "r") as f:
+                if f.read() == content:
+                    # two files are identical, do not touch
+                    print("[identical, no touch]")
+                    return "unchanged"
+            print("[overwrite]")
+            action = "updated"
+
+        # two files are different, save files
+        with open(jsonfile, "w") as f:
+            f.write(content)
+        if self.if_save_preview:
+            save_preview(f"{file_path}.html", doc["text"], doc["url"])
+        return action
+
+    def source_id(self, file_path: str) -> str:
+        return f"{file_path}.json"
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SegmentSink:
+    """
+    Append documents to JSONL segment files, rotated by size, to avoid
+    one inode per document. feeder.py reads the segments as-is.
+    """
+
+    def __init__(self, directory: str, prefix: str, max_bytes=64 << 20):
+        mkdir_p(directory)
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.fh = None
+        self.seq = 0
+        # lines written to the current segment
+        self.lines = 0
+
+    def rotate(self):
+        self.close()
+        self.seq += 1
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        name = f"{self.prefix}-{stamp}-{os.getpid()}-{self.seq:05d}.jsonl"
+        self.fh = open(os.path.join(self.directory, name), "a")
+        self.lines = 0
+
+    def write(self, file_path: str, doc, src_id=None) -> None:
+        if self.fh is None or self.fh.tell() >= self.max_bytes:
+            self.rotate()
+        self.fh.write(dump_document(doc) + "\n")
+        self.lines += 1
+
+    def source_id(self, file_path: str) -> str:
+        # the line just written, as feeder.py names lines of JSONL files
+        return f"{self.fh.name}:{self.lines - 1}"
+
+    def flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+
+class IndexdSink:
+    """
+    Map documents through the field map of feeder.py and stream them to
+    indexd in batches, instead of re-walking the output after each pass.
+    A batch is also flushed after `interval` seconds without a write,
+    so documents do not wait while the crawler is idle (e.g., patrol).
+    """
+
+    def __init__(
+        self, config_path: str, corpus="crawler", batch_size=32, interval=5.0
+    ):
+        import configparser
+        sys.path.insert(0, os.path.join(script_dir, "feeder"))
+        import feeder
+
+        config = configparser.ConfigParser()
+        if not config.read(config_path):
+            raise Exception(f"cannot read feeder config {config_path}")
+        section = config[corpus]
+        indexd_urls = json.loads(section["indexd_url"])
+        self.feeder = feeder
+        self.feeding = feeder.start_feeding(indexd_urls, section)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batch = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.timer = threading.Thread(target=self.flush_timer, daemon=True)
+        self.timer.start()
+
+    def write(self, file_path: str, doc, src_id=None) -> None:
+        # use the same src_id feeder.py would see walking the output
+        with self.lock:
+            self.batch.append((src_id or f"{file_path}.json", doc))
+            if (len(self.batch) >= self.batch_size or
+                    time.time() - self.last_flush >= self.interval):
+                self.flush_batch()
+
+    def flush_batch(self):
+        # with self.lock held, feeding does not block (see feeder.enqueue)
+        for src_id, doc in self.batch:
+            self.feeder.feed_document(self.feeding, src_id, doc)
+        self.batch = []
+        self.last_flush = time.time()
+
+    def flush_timer(self):
+        while not self.closing.wait(self.interval):
+            with self.lock:
+                if time.time() - self.last_flush >= self.interval:
+                    self.flush_batch()
+
+    def flush(self):
+        with self.lock:
+            self.flush_batch()
+
+    def close(self):
+        self.closing.set()
+        self.timer.join()
+        self.flush()
+        self.feeder.stop_feeding(self.feeding)
+
+
+class NearDupFilter:
+    """
+    Not a real sink, but put in front of the others: look up each
+    document in a near-duplicate index (see near_dup.py), then either
+    flag it with a `near_dup_of` field, or drop it from further sinks.
+    """
+
+    def __init__(self, mode: str, threshold: float, index_path: str):
+        from near_dup import open_index
+
+        self.mode = mode
+        self.index = open_index(index_path, threshold)
+
+    def write(self, file_path: str, doc, src_id=None):
+        doc_id = os.path.basename(file_path)
+        dup_of, sim = self.index.check(doc_id, doc["text"])
+        if dup_of is None:
+            return None
+        print(f"[near-dup] {doc_id} ~ {dup_of} ({sim:.3f})")
+        if self.mode == "drop":
+            return "duplicate"
+        doc["near_dup_of"] = dup_of
+        return None
+
+    def flush(self):
+        self.index.flush()
+        self.index.report()
+
+    def close(self):
+        from near_dup import close_index
+
+        self.index.report()
+        close_index(self.index)
+
+
+class ChangeFilter:
+    """
+    Not a real sink either: without the filesystem sink, nothing else
+    tells whether a document has changed, so keep a content hash of
+    every document written (sqlite, by document ID), and stop unchanged
+    ones from being appended or sent to indexd again.
+    """
+
+    def __init__(self, path: str):
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (doc TEXT PRIMARY KEY, hash BLOB)"
+        )
+        self.db.commit()
+
+    def write(self, file_path: str, doc, src_id=None) -> str:
+        import hashlib
+        doc_id = os.path.basename(file_path)
+        content = dump_document(doc).encode("utf-8")
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        row = self.db.execute(
+            "SELECT hash FROM hashes WHERE doc = ?", (doc_id,)
+        ).fetchone()
+        if row is not None and row[0] == digest:
+            return "unchanged"
+        self.db.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?)", (doc_id, digest)
+        )
+        return "created" if row is None else "updated"
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def dedup_options(extra_opt):
+    # (mode, threshold, index path) from --dedup* crawler options
+    if extra_opt["dedup"] is None:
+        return None
+    return (
+        extra_opt["dedup"], extra_opt["dedup-threshold"],
+        extra_opt["dedup-index"]
+    )
+
+
+def make_sinks(
+    names, file_prefix, if_save_preview, sink_config, corpus, dedup=None
+):
+    # near-duplicates are flagged (or dropped) before anything is written,
+    # then the filesystem sink (or a content hash without it) goes first,
+    # it decides whether a document has changed at all.
+    sinks = []
+    if dedup is not None:
+        sinks.append(NearDupFilter(*dedup))
+    if "fs" in names:
+        sinks.append(FileSink(if_save_preview))
+    else:
+        sinks.append(ChangeFilter(f"{file_prefix}-hashes.sqlite"))
+    if "segment" in names:
+        sinks.append(SegmentSink("./tmp/segments", file_prefix))
+    if "indexd" in names:
+        sinks.append(IndexdSink(sink_config, corpus))
+    return sinks
+
+
+def write_to_sinks(sinks, file_path: str, doc):
+    # (action, source ID of the document as feeder.py sees it), i.e., its
+    # JSON file, or its segment line when there is no filesystem sink.
+    action, src_id = "created", None
+    for sink in sinks:
+        action = sink.write(file_path, doc, src_id) or action
+        if action in ("unchanged", "duplicate"):
+            break
+        if src_id is None and hasattr(sink, "source_id"):
+            src_id = sink.source_id(file_path)
+    return action, src_id or f"{file_path}.json"
+
+
+def flush_sinks(sinks):
+    for sink in sinks:
+        sink.flush()
+
+
+def close_sinks(sinks):
+    for sink in sinks:
+        sink.close()
@@ -0,0 +1,166 @@
+import os
+import glob
+import json
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from post_sink import render_preview
+from doc_keys import doc_id_key, url_key
+
+# sub-directories of the ./tmp layout, see get_file_path() of crawlers
+DIVISIONS = 500
+
+
+def same_host(doc, url: str) -> bool:
+    return urlsplit(doc["url"]).netloc == urlsplit(url).netloc
+
+
+class SegmentIndex:
+    """
+    Where documents are in JSONL segments (see post_sink.SegmentSink),
+    by key, with the file prefix of their segment. Segments only grow,
+    so refresh() reads what was appended since the last time, and only
+    on a miss.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.offsets = {}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        pattern = os.path.join(self.directory, "*.jsonl")
+        for path in sorted(glob.glob(pattern)):
+            prefix = os.path.basename(path).split("-")[0]
+            with open(path, "r") as fh:
+                fh.seek(self.offsets.get(path, 0))
+                while True:
+                    offset = fh.tell()
+                    line = fh.readline()
+                    if not line.endswith("\n"):
+                        # not completely written yet
+                        break
+                    key = url_key(json.loads(line)["url"])
+                    if key is not None:
+                        entries = self.entries.setdefault(key[0], [])
+                        entries.append((prefix, path, offset))
+                    self.offsets[path] = fh.tell()
+
+    def read(self, path: str, offset: int):
+        with open(path, "r") as fh:
+            fh.seek(offset)
+            return json.loads(fh.readline())
+
+    def find(self, prefix, key: str, url=None):
+        # latest copy of the document, of the host of `url` if given
+        with self.lock:
+            for refresh in (False, True):
+                if refresh:
+                    self.refresh()
+                for p, path, offset in reversed(self.entries.get(key, [])):
+                    if prefix not in (None, p):
+                        continue
+                    doc = self.read(path, offset)
+                    if url is None or same_host(doc, url):
+                        return doc
+        return None
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    """
+    /preview/<doc id> or /preview?url=<post url> renders a document
+    through template.html, instead of crawlers writing a preview file
+    per document (--save-preview).
+    """
+    # set by make_server()
+    corpus = None
+    segments = None
+
+    def do_GET(self):
+        split = urlsplit(self.path)
+        query = parse_qs(split.query)
+        if split.path.startswith("/preview/"):
+            doc = self.find_by_id(split.path[len("/preview/"):])
+        elif split.path == "/preview" and "url" in query:
+            doc = self.find_by_url(query["url"][0])
+        else:
+            self.send_error(404, "use /preview/<doc id> or /preview?url=<url>")
+            return
+        if doc is None:
+            self.send_error(404, "no such document")
+            return
+        body = render_preview(doc["text"], doc["url"]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def find_by_id(self, doc_id: str):
+        key = doc_id_key(doc_id)
+        if key is None:
+            return None
+        prefix, key, number = key
+        path = os.path.join(self.corpus, str(number % DIVISIONS), doc_id)
+        if os.path.isfile(path + ".json"):
+            with open(path + ".json", "r") as fh:
+                return json.load(fh)
+        if self.segments is not None:
+            return self.segments.find(prefix, key)
+        return None
+
+    def find_by_url(self, url: str):
+        key = url_key(url)
+        if key is None:
+            return None
+        key, number = key
+        # any site prefix, e.g., mse1886701.json or aops-c6h1p2.json
+        name = key.split("/")[-1]
+        if name.isdigit():
+            name = f"[a-z]{name}"
+        directory = os.path.join(self.corpus, str(number % DIVISIONS))
+        pattern = os.path.join(directory, f"*{name}.json")
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r") as fh:
+                doc = json.load(fh)
+            if same_host(doc, url):
+                return doc
+        if self.segments is not None:
+            return self.segments.find(None, key, url)
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(corpus: str, segments: str, host: str, port: int):
+    PreviewHandler.corpus = corpus
+    if os.path.isdir(segments):
+        PreviewHandler.segments = SegmentIndex(segments)
+    return ThreadingHTTPServer((host, port), PreviewHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve HTML previews of crawled documents on request."
+    )
+    parser.add_argument(
+        "--corpus", help="crawled JSON files (default: ./tmp)",
+        type=str, default="./tmp"
+    )
+    parser.add_argument(
+        "--segments", help="JSONL segments (default: ./tmp/segments)",
+        type=str, default="./tmp/segments"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    server = make_server(args.corpus, args.segments, args.host, args.port)
+    print(f"[preview] http://{args.host}:{args.port}/preview/<doc id>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,72 @@
+import time
+import threading
+from urllib.parse import urlsplit
+
+# one bucket per host, shared by everything crawling that host
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average, and bursts of up to
+    `burst` requests. A rate of zero (or less) means no limit.
+
+    Tokens are reserved under the lock and waited for outside of it, so
+    concurrent callers of one bucket are spaced out instead of woken up
+    all at once, while callers of other buckets are not blocked at all.
+    """
+
+    def __init__(self, rate: float, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def available_in(self) -> float:
+        # seconds until a token is available, without taking it
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate > 0:
+                elapsed = now - self.stamp
+                tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / self.rate)
+            return wait
+
+    def reserve(self) -> float:
+        # take a token (possibly in advance), return seconds to wait for it
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate > 0:
+                elapsed = now - self.stamp
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.stamp = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        # e.g., the host tells us we are too frequent
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.paused_until = max(self.paused_until, until)
+
+
+def host_bucket(url: str, rate: float, burst=1.0) -> TokenBucket:
+    host = urlsplit(url).netloc
+    with buckets_lock:
+        if host not in buckets:
+            buckets[host] = TokenBucket(rate, burst)
+        return buckets[host]
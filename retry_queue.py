@@ -0,0 +1,116 @@
+import json
+import time
+import threading
+
+# seconds before the first retry, doubled on every further failure
+BASE_DELAY = 60.0
+MAX_DELAY = 6 * 3600.0
+MAX_ATTEMPTS = 6
+
+# quick tries of requests the rest of a crawl depends on (listing pages,
+# sessions), seconds before the first retry, doubled on every further one
+SOON_ATTEMPTS = 4
+SOON_DELAY = 5.0
+
+
+def retry_soon(func, *args, attempts=SOON_ATTEMPTS, delay=SOON_DELAY,
+        **kwargs):
+    """
+    Call func(*args, **kwargs), trying again a few times after short
+    waits, for requests that can not wait in a RetryQueue: without a
+    listing page, none of the documents on it are even known.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            if attempt == attempts:
+                raise
+            print(f"[retry] {err}, try again in {delay:.0f} sec")
+            time.sleep(delay)
+            delay *= 2
+
+
+class RetryQueue:
+    """
+    Persistent queue of failed items (JSON-serializable dicts), so that
+    a crawl goes on instead of sleeping on one bad URL, and failures
+    outlive the process. Each failure pushes an item's due time back
+    with exponential backoff, after max_attempts failures it is given
+    up on, but kept (with its last error) for inspection.
+
+    Thread-safe, items also fail in pipeline threads.
+    """
+
+    def __init__(self, path: str, base_delay=BASE_DELAY,
+            max_delay=MAX_DELAY, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        # imported here, retry_soon() is used without a queue
+        import sqlite3
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS retries (
+                key TEXT PRIMARY KEY, item TEXT, attempts INTEGER,
+                due REAL, error TEXT
+            )
+        """)
+        self.db.commit()
+
+    def add(self, key: str, item, err: str):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT attempts FROM retries WHERE key = ?", (key,)
+            ).fetchone()
+            attempts = 1 if row is None else row[0] + 1
+            if attempts >= self.max_attempts:
+                # given up on, never due
+                due = None
+                print(f"[retry] give up {key} after {attempts} attempts")
+            else:
+                delay = self.base_delay * 2 ** (attempts - 1)
+                due = time.time() + min(delay, self.max_delay)
+            self.db.execute(
+                "INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(item), attempts, due, err)
+            )
+            self.db.commit()
+
+    def done(self, key: str):
+        with self.lock:
+            self.db.execute("DELETE FROM retries WHERE key = ?", (key,))
+            self.db.commit()
+
+    def due(self, until=None):
+        # [(key, item)] due by `until` (default: now), earliest first
+        if until is None:
+            until = time.time()
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, item FROM retries WHERE due <= ? ORDER BY due",
+                (until,)
+            ).fetchall()
+        return [(key, json.loads(item)) for key, item in rows]
+
+    def next_due(self):
+        # unix time of the next retry, None if nothing is pending
+        with self.lock:
+            return self.db.execute("SELECT MIN(due) FROM retries").fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            pending, given_up = self.db.execute(
+                "SELECT COUNT(due), COUNT(*) - COUNT(due) FROM retries"
+            ).fetchone()
+        return {"pending": pending, "given_up": given_up}
+
+    def report(self):
+        print(f"[retry] {self.path}", self.stats())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,186 @@
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+
+# prior belief of a document changing about once a week, so that a few
+# unchanged visits do not make a document look dead forever
+PRIOR_CHANGES = 1.0
+PRIOR_SECONDS = 7 * 24 * 3600.0
+
+# how recent "recently active" is, when a listing does not tell the time
+HINT_WINDOW = 3600.0
+
+# most of the budget one round of revisits may take, so that listing
+# new documents is not held up for long
+ROUND_SECONDS = 300.0
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def change_rate(changes: int, observed: float) -> float:
+    # estimated changes per second, as a Poisson process
+    return (changes + PRIOR_CHANGES) / (observed + PRIOR_SECONDS)
+
+
+def staleness(changes: int, observed: float, last_visit: float,
+        now: float) -> float:
+    # probability of a document having changed since the last visit
+    rate = change_rate(changes, observed)
+    return 1.0 - math.exp(-rate * max(now - last_visit, 0.0))
+
+
+def next_visit(rate: float, cost: float) -> float:
+    # seconds until a document has changed with probability 1/2, i.e.,
+    # 1 - exp(-rate * t) = 1/2, times the requests it costs
+    return math.log(2) * cost / rate
+
+
+class RevisitScheduler:
+    """
+    Patrol frontier of already crawled documents, and the request budget
+    of the whole patrol. Every visit records a content hash, from whose
+    history a change rate is estimated, and the time the document is
+    next due: when it has likely changed (half a chance of it, or more
+    for documents of several requests). due() then hands out the due
+    documents most likely changed per request first.
+
+    Every request (listing pages and new documents too) is paid with
+    spend(), which waits while the hourly budget is used up, so the
+    budget is what the whole patrol requests.
+
+    Documents listed as recently active can be hinted to go first.
+    Thread-safe, visits are recorded by pipeline threads as well.
+    """
+
+    def __init__(self, path: str, budget_per_hour: float):
+        self.path = path
+        self.budget = budget_per_hour
+        self.tokens = 0.0
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.create_function("staleness", 4, staleness)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS docs (
+                key TEXT PRIMARY KEY, target TEXT,
+                last_visit REAL, last_hash TEXT,
+                visits INTEGER, changes INTEGER, observed REAL,
+                cost REAL, due REAL
+            )
+        """)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(docs)")]
+        if "due" not in columns:
+            # frontier of an earlier version, due right away
+            self.db.execute("ALTER TABLE docs ADD COLUMN due REAL DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS docs_due ON docs (due)")
+        self.db.commit()
+
+    def refill(self, now: float):
+        # accrue the budget since the last time, at most an hour of it
+        hours = (now - self.stamp) / 3600.0
+        self.tokens = min(self.budget, self.tokens + hours * self.budget)
+        self.stamp = now
+
+    def spend(self, cost=1.0):
+        # pay for requests, waiting for the budget to accrue if needed
+        while True:
+            with self.lock:
+                self.refill(time.time())
+                cost = min(cost, self.budget)
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.budget * 3600.0
+            time.sleep(wait)
+
+    def known(self, key: str) -> bool:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM docs WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None
+
+    def hint(self, key: str, changed_at=None):
+        # e.g., listed as active, the document goes first if it changed
+        # (at unix time changed_at) after our last visit.
+        if changed_at is None:
+            changed_at = time.time() - HINT_WINDOW
+        with self.lock:
+            self.db.execute(
+                "UPDATE docs SET due = 0 WHERE key = ? AND last_visit < ?",
+                (key, changed_at)
+            )
+            self.db.commit()
+
+    def record(self, key: str, target: str, digest: str, cost=1.0):
+        # a visit of `target` (what to request for revisiting `key`),
+        # costing some requests, found content of hash `digest`
+        now = time.time()
+        cost = max(cost, 1.0)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT last_visit, last_hash, visits, changes, observed "
+                "FROM docs WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                visits, changes, observed = 1, 0, 0.0
+            else:
+                last_visit, last_hash, visits, changes, observed = row
+                visits += 1
+                changes += 1 if digest != last_hash else 0
+                observed += now - last_visit
+            due = now + next_visit(change_rate(changes, observed), cost)
+            self.db.execute(
+                "INSERT OR REPLACE INTO docs (key, target, last_visit, "
+                "last_hash, visits, changes, observed, cost, due) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, target, now, digest, visits, changes, observed, cost,
+                    due)
+            )
+            self.db.commit()
+
+    def due(self):
+        """
+        Return [(key, target)] of the documents due for a revisit (read
+        off the index on due times), by expected staleness per request:
+        hinted ones first, then by the probability of having changed
+        over cost. At most a round of budget is handed out at once, the
+        requests are paid with spend() as they are made.
+        """
+        now = time.time()
+        limit = max(1, int(self.budget * ROUND_SECONDS / 3600.0))
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, target, cost FROM docs WHERE due <= ? "
+                "ORDER BY CASE WHEN due = 0 THEN 1.0 ELSE "
+                "staleness(changes, observed, last_visit, ?) END / cost "
+                "DESC LIMIT ?", (now, now, limit)
+            )
+            due = []
+            for key, target, cost in rows:
+                # documents of several requests take several tokens
+                limit -= cost
+                if len(due) > 0 and limit < 0:
+                    break
+                due.append((key, target))
+        return due
+
+    def stats(self):
+        with self.lock:
+            docs, visits, changes = self.db.execute(
+                "SELECT COUNT(*), SUM(visits), SUM(changes) FROM docs"
+            ).fetchone()
+        return {"documents": docs, "visits": visits or 0,
+            "changes": changes or 0}
+
+    def report(self):
+        print(f"[revisit] {self.path}", self.stats())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
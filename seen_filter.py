@@ -0,0 +1,191 @@
+import os
+import re
+import math
+import mmap
+import json
+import struct
+import hashlib
+import argparse
+from doc_keys import url_key
+
+MAGIC = b"A0SEEN1\0"
+# magic, number of bits, number of hashes
+HEADER = struct.Struct("<8sQI")
+# bits start after the header, aligned
+BITS_OFFSET = 32
+# bytes OR-ed at a time when merging
+BLOCK = 1 << 20
+
+# the same default size on every node, so that filters can be merged,
+# 12 MB at 1% false positives
+DEFAULT_CAPACITY = 10000000
+
+
+def optimal_size(capacity: int, fp_rate: float):
+    # (bits, hashes) of a Bloom filter for capacity items at fp_rate
+    bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+    bits = max(64, (bits + 63) // 64 * 64)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class SeenFilter:
+    """
+    Bloom filter of document IDs (e.g., "mse1886701", "aops-c6h1234"),
+    in a file mapped into memory, so that it is loaded at once and only
+    the pages touched by lookups are read. Filters of the same size are
+    merged by OR-ing their bits, e.g., to share what other nodes have
+    crawled. A Bloom filter (unlike an xor filter) can be merged and
+    added to, at about 10 bits per ID for 1% false positives.
+    """
+
+    def __init__(self, path: str, writable=False):
+        self.path = path
+        self.fh = open(path, "r+b" if writable else "rb")
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=access)
+        magic, self.bits, self.hashes = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a seen filter")
+
+    @staticmethod
+    def create(path: str, capacity: int, fp_rate=0.01):
+        bits, hashes = optimal_size(max(capacity, 1), fp_rate)
+        with open(path, "wb") as fh:
+            header = HEADER.pack(MAGIC, bits, hashes)
+            fh.write(header.ljust(BITS_OFFSET, b"\0"))
+            fh.truncate(BITS_OFFSET + bits // 8)
+        return SeenFilter(path, writable=True)
+
+    def positions(self, doc_id: str):
+        # double hashing, k positions out of two 64-bit hashes
+        digest = hashlib.blake2b(doc_id.encode("utf-8"), digest_size=16)
+        digest = digest.digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, doc_id: str):
+        for pos in self.positions(doc_id):
+            offset = BITS_OFFSET + (pos >> 3)
+            self.mm[offset] = self.mm[offset] | (1 << (pos & 7))
+
+    def __contains__(self, doc_id: str) -> bool:
+        return all(
+            self.mm[BITS_OFFSET + (pos >> 3)] & (1 << (pos & 7))
+            for pos in self.positions(doc_id)
+        )
+
+    def merge(self, other):
+        if (other.bits, other.hashes) != (self.bits, self.hashes):
+            raise Exception(f"{other.path} differs in size from {self.path}")
+        end = BITS_OFFSET + self.bits // 8
+        for begin in range(BITS_OFFSET, end, BLOCK):
+            n = min(BLOCK, end - begin)
+            a = int.from_bytes(self.mm[begin:begin + n], "little")
+            b = int.from_bytes(other.mm[begin:begin + n], "little")
+            self.mm[begin:begin + n] = (a | b).to_bytes(n, "little")
+
+    def stats(self):
+        end = BITS_OFFSET + self.bits // 8
+        ones = 0
+        for begin in range(BITS_OFFSET, end, BLOCK):
+            block = self.mm[begin:min(begin + BLOCK, end)]
+            # int.bit_count() needs Python 3.10
+            ones += bin(int.from_bytes(block, "little")).count("1")
+        fill = ones / self.bits
+        # estimated number of IDs added, -1 if full
+        items = -1
+        if fill < 1:
+            items = -self.bits / self.hashes * math.log(1 - fill)
+        return {
+            "bytes": end,
+            "hashes": self.hashes,
+            "fill_ratio": round(fill, 4),
+            "estimated_ids": round(items),
+            "false_positive_rate": round(fill ** self.hashes, 6)
+        }
+
+    def report(self):
+        print(f"[seen] {self.path}", self.stats())
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+
+def doc_ids(name: str):
+    # a document ID, and the topic of AoPS chunks, e.g., "aops-c6h1234"
+    yield name
+    res = re.fullmatch(r"(.+-c\d+h\d+)p\d+", name)
+    if res is not None:
+        yield res.group(1)
+
+
+def corpus_ids(corpus_path: str):
+    """
+    IDs of crawled JSON files (their names) and of documents in JSONL
+    segments (named by site prefix and URL, as the crawlers would).
+    """
+    for dirname, dirs, files in os.walk(corpus_path):
+        for f in files:
+            if f.endswith(".json"):
+                yield from doc_ids(f[:-len(".json")])
+            elif f.endswith(".jsonl"):
+                prefix = f.split("-")[0]
+                with open(os.path.join(dirname, f), "r") as fh:
+                    for line in fh:
+                        key = url_key(json.loads(line)["url"])
+                        if key is None:
+                            continue
+                        elif key[0].startswith("questions/"):
+                            yield prefix + key[0][len("questions/"):]
+                        else:
+                            yield from doc_ids(f"{prefix}-{key[0]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build, merge or query a filter of crawled document IDs."
+    )
+    parser.add_argument("FILTER", help="filter file", type=str)
+    parser.add_argument(
+        "--build", help="add the IDs of crawled output trees, creating the "
+        "filter if it does not exist", type=str, nargs="+",
+        metavar="CORPUS_PATH", default=[]
+    )
+    parser.add_argument(
+        "--capacity", help="IDs a new filter is sized for "
+        f"(default: {DEFAULT_CAPACITY})", type=int, default=DEFAULT_CAPACITY
+    )
+    parser.add_argument(
+        "--fp-rate", help="false positive rate at capacity (default: 0.01)",
+        type=float, default=0.01
+    )
+    parser.add_argument(
+        "--merge", help="OR other filters of the same size into the filter",
+        type=str, nargs="+", metavar="OTHER_FILTER", default=[]
+    )
+    parser.add_argument(
+        "--check", help="print whether document IDs are in the filter",
+        type=str, nargs="+", metavar="DOC_ID", default=[]
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.FILTER):
+        seen = SeenFilter.create(args.FILTER, args.capacity, args.fp_rate)
+    else:
+        writable = len(args.build) > 0 or len(args.merge) > 0
+        seen = SeenFilter(args.FILTER, writable=writable)
+    for path in args.build:
+        for doc_id in corpus_ids(path):
+            seen.add(doc_id)
+    for path in args.merge:
+        other = SeenFilter(path)
+        seen.merge(other)
+        other.close()
+    for doc_id in args.check:
+        print(doc_id, "seen" if doc_id in seen else "not seen")
+    seen.report()
+    seen.close()
@@ -0,0 +1,23 @@
+"""
+slimit JavaScript parser with PLY tables cached in this package.
+
+The tables shipped with slimit are generated by an old PLY version, so a
+newer PLY rejects them and builds the LALR tables again on every Parser()
+(and tries to write them into site-packages). Here they are generated
+once into this directory, preferably when the image is built:
+
+    python3 -m slimit_tables
+"""
+
+parser = None
+
+
+def get_parser():
+    # created on first use, most crawler modes never parse JavaScript
+    global parser
+    if parser is None:
+        from slimit.parser import Parser
+        parser = Parser(
+            lextab=f"{__name__}.lextab", yacctab=f"{__name__}.yacctab"
+        )
+    return parser
@@ -0,0 +1,12 @@
+import os
+import time
+import compileall
+from slimit_tables import get_parser
+
+begin = time.perf_counter()
+get_parser()
+# byte-compile the (large) tables as well, for they are imported at startup
+directory = os.path.dirname(os.path.abspath(__file__))
+compileall.compile_dir(directory, quiet=1)
+print(f"[slimit tables] {directory}",
+    f"ready in {time.perf_counter() - begin:.3f} sec")
@@ -0,0 +1,201 @@
+import os
+import time
+import json
+import atexit
+import bisect
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# upper bounds (in seconds) of latency histogram buckets
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+stages = {}
+counters = {}
+lock = threading.Lock()
+
+
+def reset_lock():
+    # a thread of the parent (e.g., serving metrics) may hold the lock
+    # when pipeline workers are forked, they would wait on it forever.
+    global lock
+    lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_lock)
+
+# per-stage cProfile data, only collected if enable_profile() is called
+profile_dir = None
+profiles = {}
+local = threading.local()
+
+
+def observe(stage: str, seconds: float, failed=False):
+    with lock:
+        if stage not in stages:
+            stages[stage] = {
+                "count": 0,
+                "errors": 0,
+                "sum": 0.0,
+                "buckets": [0] * (len(BUCKETS) + 1)
+            }
+        s = stages[stage]
+        s["count"] += 1
+        s["errors"] += 1 if failed else 0
+        s["sum"] += seconds
+        s["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+def incr(counter: str, n=1):
+    with lock:
+        counters[counter] = counters.get(counter, 0) + n
+
+
+@contextmanager
+def timed(stage: str):
+    prof = start_profile(stage)
+    begin = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        observe(stage, time.perf_counter() - begin, failed)
+        stop_profile(prof)
+
+
+def instrument(stage: str):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable_profile(directory: str):
+    global profile_dir
+    os.makedirs(directory, exist_ok=True)
+    profile_dir = directory
+    atexit.register(dump_profiles)
+
+
+def start_profile(stage: str):
+    # only the outermost stage of a thread is profiled, one thread can
+    # not have two active profilers (inner stages show up in it anyway).
+    if profile_dir is None or getattr(local, "profiling", False):
+        return None
+    import cProfile
+    key = (stage, threading.get_ident())
+    with lock:
+        if key not in profiles:
+            profiles[key] = cProfile.Profile()
+        prof = profiles[key]
+    local.profiling = True
+    prof.enable()
+    return prof
+
+
+def stop_profile(prof):
+    if prof is not None:
+        prof.disable()
+        local.profiling = False
+
+
+def dump_profiles():
+    import pstats
+    merged = {}
+    with lock:
+        for (stage, _), prof in profiles.items():
+            if stage in merged:
+                merged[stage].add(prof)
+            else:
+                merged[stage] = pstats.Stats(prof)
+    for stage, stats in merged.items():
+        path = os.path.join(profile_dir, f"{stage}.prof")
+        stats.dump_stats(path)
+        print(f"[profile] {path}")
+
+
+def snapshot():
+    with lock:
+        return {
+            "time": time.time(),
+            "buckets": BUCKETS,
+            "stages": json.loads(json.dumps(stages)),
+            "counters": dict(counters)
+        }
+
+
+def prometheus_text() -> str:
+    snap = snapshot()
+    lines = ["# TYPE a0_stage_seconds histogram"]
+    for stage, s in sorted(snap["stages"].items()):
+        cumulative = 0
+        for le, n in zip(BUCKETS + ["+Inf"], s["buckets"]):
+            cumulative += n
+            lines.append(
+                f'a0_stage_seconds_bucket{{stage="{stage}",le="{le}"}} '
+                f'{cumulative}'
+            )
+        lines.append(f'a0_stage_seconds_sum{{stage="{stage}"}} {s["sum"]}')
+        lines.append(f'a0_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+    lines.append("# TYPE a0_stage_errors_total counter")
+    for stage, s in sorted(snap["stages"].items()):
+        lines.append(f'a0_stage_errors_total{{stage="{stage}"}} {s["errors"]}')
+    lines.append("# TYPE a0_events_total counter")
+    for counter, n in sorted(snap["counters"].items()):
+        lines.append(f'a0_events_total{{event="{counter}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(port: int, host="0.0.0.0"):
+    # imported here, most runs do not serve metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics"):
+                body = prometheus_text().encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            elif self.path.startswith("/stats.json"):
+                body = json.dumps(snapshot()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"[metrics] http://{host}:{port}/metrics")
+    return server
+
+
+def dump_json(path: str):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def dump_json_periodically(path: str, interval=10.0):
+    def dump():
+        while True:
+            time.sleep(interval)
+            dump_json(path)
+
+    atexit.register(dump_json, path)
+    thread = threading.Thread(target=dump, daemon=True)
+    thread.start()
+    return thread